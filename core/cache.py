@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#
+# MIMEfield - MIME type mismatch detection tool
+# Cache core module
+# Copyright (c) 2022 by Ralf Kilian
+# Distributed under the MIT License (https://opensource.org/licenses/MIT)
+#
+# GitHub: https://github.com/urbanware-org/mimefield
+# GitLab: https://gitlab.com/urbanware-org/mimefield
+#
+
+import os
+import sqlite3
+import threading
+import time
+
+# Maximum number of files kept in the cache, the least recently used ones are
+# evicted when the cache is closed
+CACHE_SIZE = 1000000
+
+# Number of changes collected before they are written to the cache
+FLUSH_SIZE = 1024
+
+# Version of the cache layout, a different one discards the cache
+CACHE_VERSION = "1"
+
+# Time (in nanoseconds) a directory must not have been modified before it was
+# listed for the listing to be reused, as the modification time of a
+# directory may have a coarse granularity (e.g. two seconds on FAT)
+RACY_TIME = 2000000000
+
+
+def get_cache_path(path):
+    """
+        Get the absolute path of a cache file after checking that its
+        directory exists.
+    """
+    path = os.path.abspath(path)
+    if os.path.isdir(path):
+        raise IsADirectoryError("The given cache file is a directory")
+    if not os.path.isdir(os.path.dirname(path)):
+        raise FileNotFoundError("The directory of the given cache file does "
+                                "not exist")
+
+    return path
+
+
+class ScanCache():
+    """
+        On-disk cache of the type strings of files, identified by their
+        status (device, inode, size and modification time), so unchanged
+        files do not have to be opened again. Furthermore, it keeps the
+        listings of directories, so unchanged directories do not have to be
+        listed again.
+    """
+
+    def __init__(self, path, backend, size=CACHE_SIZE):
+        if size < 1:
+            raise ValueError("The cache size must be at least 1")
+
+        self.path = path
+        self.backend = f"{CACHE_VERSION}|{backend}"
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+        self.__stores = []
+        self.__touches = []
+        self.__listings = []
+        self.__listing_touches = []
+
+        # The cache may be used from the thread walking the directories
+        self.__db = sqlite3.connect(path, check_same_thread=False)
+        try:
+            self.__setup()
+        except sqlite3.Error:
+            self.__db.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+            Write the pending changes, evict the least recently used files
+            if the cache is full and close the cache.
+        """
+        with self.__lock:
+            if self.__db is None:
+                return
+            try:
+                self.__flush()
+                self.__evict()
+            finally:
+                self.__db.close()
+                self.__db = None
+
+    def flush(self):
+        """
+            Write the pending changes, so they are available to further
+            lookups (e.g. of the next scan).
+        """
+        with self.__lock:
+            if self.__db is not None:
+                self.__flush()
+
+    def get_type(self, status, expected=""):
+        """
+            Get the type string of a file from the cache by its status or
+            'None' if it is not cached (or has changed since).
+        """
+        key = self.__get_key(status)
+        with self.__lock:
+            row = self.__db.execute(
+                "SELECT size, mtime_ns, expected, ftype FROM files "
+                "WHERE dev = ? AND ino = ?", key).fetchone()
+            if row is None or row[:3] != (status.st_size,
+                                          status.st_mtime_ns, expected):
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.__touches.append(key)
+            if len(self.__touches) >= FLUSH_SIZE:
+                self.__flush()
+
+        return row[3]
+
+    def get_listing(self, path, status):
+        """
+            Get the names of the files and sub-directories of a directory
+            from the cache by its status or 'None' if it is not cached (or
+            has changed since).
+        """
+        key = os.fsencode(os.path.abspath(path))
+        dev, ino = self.__get_key(status)
+        with self.__lock:
+            row = self.__db.execute(
+                "SELECT dev, ino, mtime_ns, listed_ns, files, subdirs "
+                "FROM directories WHERE path = ?", (key,)).fetchone()
+            if row is None or row[:3] != (dev, ino, status.st_mtime_ns) or \
+                    row[2] >= row[3] - RACY_TIME:
+                return None
+
+            self.__listing_touches.append(key)
+            if len(self.__listing_touches) >= FLUSH_SIZE:
+                self.__flush()
+
+        return self.__split_names(row[4]), self.__split_names(row[5])
+
+    def invalidate(self):
+        """
+            Remove all files and directory listings from the cache.
+        """
+        with self.__lock:
+            self.__stores.clear()
+            self.__touches.clear()
+            self.__listings.clear()
+            self.__listing_touches.clear()
+            with self.__db:
+                self.__db.execute("DELETE FROM files")
+                self.__db.execute("DELETE FROM directories")
+
+    def set_listing(self, path, status, files, subdirs, listed_ns=None):
+        """
+            Store the names of the files and sub-directories of a directory
+            listed at the given time (by default now) in the cache.
+        """
+        if listed_ns is None:
+            listed_ns = time.time_ns()
+
+        key = os.fsencode(os.path.abspath(path))
+        dev, ino = self.__get_key(status)
+        with self.__lock:
+            self.__listings.append((key, dev, ino, status.st_mtime_ns,
+                                    len(files) + len(subdirs), listed_ns,
+                                    self.__join_names(files),
+                                    self.__join_names(subdirs),
+                                    self.__generation))
+            if len(self.__listings) >= FLUSH_SIZE:
+                self.__flush()
+
+    def set_type(self, status, ftype, expected=""):
+        """
+            Store the type string of a file in the cache.
+        """
+        dev, ino = self.__get_key(status)
+        with self.__lock:
+            self.__stores.append((dev, ino, status.st_size,
+                                  status.st_mtime_ns, expected, ftype,
+                                  self.__generation))
+            if len(self.__stores) >= FLUSH_SIZE:
+                self.__flush()
+
+    def __evict(self):
+        """
+            Remove the least recently used files and directory listings
+            exceeding the cache size.
+        """
+        count = self.__db.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+        if count > self.size:
+            with self.__db:
+                self.__db.execute(
+                    "DELETE FROM files WHERE (dev, ino) IN (SELECT dev, ino "
+                    "FROM files ORDER BY used LIMIT ?)", (count - self.size,))
+
+        count = self.__db.execute(
+            "SELECT COUNT(*) FROM directories").fetchone()[0]
+        if count > self.size:
+            with self.__db:
+                self.__db.execute(
+                    "DELETE FROM directories WHERE path IN (SELECT path "
+                    "FROM directories ORDER BY used LIMIT ?)",
+                    (count - self.size,))
+
+    def __flush(self):
+        """
+            Write the collected changes to the cache.
+        """
+        if not (self.__stores or self.__touches or self.__listings or
+                self.__listing_touches):
+            return
+
+        with self.__db:
+            self.__db.executemany(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                self.__stores)
+            self.__db.executemany(
+                "UPDATE files SET used = ? WHERE dev = ? AND ino = ?",
+                [(self.__generation, dev, ino)
+                 for dev, ino in self.__touches])
+            self.__db.executemany(
+                "INSERT OR REPLACE INTO directories VALUES "
+                "(?, ?, ?, ?, ?, ?, ?, ?, ?)", self.__listings)
+            self.__db.executemany(
+                "UPDATE directories SET used = ? WHERE path = ?",
+                [(self.__generation, key) for key in self.__listing_touches])
+        self.__stores.clear()
+        self.__touches.clear()
+        self.__listings.clear()
+        self.__listing_touches.clear()
+
+    @staticmethod
+    def __join_names(names):
+        """
+            Join the names of directory entries into a single value, which
+            also keeps names that cannot be decoded.
+        """
+        return b"\0".join(os.fsencode(name) for name in names)
+
+    @staticmethod
+    def __split_names(value):
+        """
+            Split a value joined from the names of directory entries.
+        """
+        if not value:
+            return []
+
+        return [os.fsdecode(name) for name in value.split(b"\0")]
+
+    @staticmethod
+    def __get_key(status):
+        """
+            Get the key of a file from its status, with the numbers fitting
+            into the (signed) integers of the database.
+        """
+        return tuple(value - (1 << 64) if value >= (1 << 63) else value
+                     for value in (status.st_dev, status.st_ino))
+
+    def __setup(self):
+        """
+            Create the tables of the cache and discard the cached files in
+            case they were identified by a different backend (e.g. another
+            version of the magic database).
+        """
+        # With write-ahead logging, other processes can still read the
+        # cache while it is being written
+        self.__db.execute("PRAGMA journal_mode = WAL")
+        self.__db.execute("PRAGMA synchronous = NORMAL")
+        with self.__db:
+            self.__db.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, "
+                "value TEXT)")
+            self.__db.execute(
+                "CREATE TABLE IF NOT EXISTS files (dev INTEGER, ino INTEGER, "
+                "size INTEGER, mtime_ns INTEGER, expected TEXT, ftype TEXT, "
+                "used INTEGER, PRIMARY KEY (dev, ino)) WITHOUT ROWID")
+            self.__db.execute(
+                "CREATE INDEX IF NOT EXISTS files_used ON files (used)")
+            self.__db.execute(
+                "CREATE TABLE IF NOT EXISTS directories (path BLOB PRIMARY "
+                "KEY, dev INTEGER, ino INTEGER, mtime_ns INTEGER, entries "
+                "INTEGER, listed_ns INTEGER, files BLOB, subdirs BLOB, used "
+                "INTEGER) WITHOUT ROWID")
+            self.__db.execute(
+                "CREATE INDEX IF NOT EXISTS directories_used ON directories "
+                "(used)")
+
+            # The directory listings do not depend on the backend, so they
+            # are kept
+            meta = dict(self.__db.execute("SELECT key, value FROM meta"))
+            if meta.get("backend") != self.backend:
+                self.__db.execute("DELETE FROM files")
+            self.__generation = int(meta.get("generation", 0)) + 1
+            self.__db.executemany(
+                "INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                [("backend", self.backend),
+                 ("generation", str(self.__generation))])
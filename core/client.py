@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#
+# MIMEfield - MIME type mismatch detection tool
+# Daemon client core module
+# Copyright (c) 2022 by Ralf Kilian
+# Distributed under the MIT License (https://opensource.org/licenses/MIT)
+#
+# GitHub: https://github.com/urbanware-org/mimefield
+# GitLab: https://gitlab.com/urbanware-org/mimefield
+#
+
+import os
+import socket
+import struct
+import tempfile
+
+# Methods the daemon can get the MIME type with
+METHODS = ["both", "file", "magic", "signature"]
+
+# Maximum size of a single frame (in bytes)
+FRAME_SIZE = 65536
+
+# Time (in seconds) to wait for the daemon to answer
+TIMEOUT = 60
+
+# Each frame is prefixed with its length as an unsigned 32-bit integer in
+# network byte order
+__length = struct.Struct("!I")
+
+# Credentials of the peer of a socket (process ID, user ID and group ID)
+__credentials = struct.Struct("3i")
+
+
+def get_mime_type(path, method="both", socket_path=None):
+    """
+        Get the MIME type of a single file from a running detection daemon
+        or 'None' if there is no daemon or it was not able to determine it
+        (so it can be determined without the daemon instead).
+    """
+    if not method:
+        method = "both"
+    if method not in METHODS or not hasattr(socket, "AF_UNIX"):
+        return None
+    if socket_path is None:
+        socket_path = get_socket_path()
+
+    # The daemon runs in a different working directory
+    request = method.encode("ascii") + b"\0" + \
+        os.fsencode(os.path.abspath(path))
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            # A connection attempt on a socket with a timeout fails right
+            # away instead of waiting while the daemon is busy accepting
+            # other clients
+            client.connect(socket_path)
+            # The socket may have been created by another user (e.g. in the
+            # temporary directory), who must not learn about the files
+            if hasattr(os, "getuid") and \
+                    __get_peer_uid(client, socket_path) != os.getuid():
+                return None
+            client.settimeout(TIMEOUT)
+            write_frame(client, request)
+            response = read_frame(client)
+    except (OSError, ValueError):
+        return None
+
+    if not response or not response.startswith(b"+"):
+        return None
+
+    return response[1:].decode("utf-8")
+
+
+def get_socket_path():
+    """
+        Get the path of the socket of the detection daemon, which is taken
+        from the 'MIMEFIELD_SOCKET' environment variable if given or located
+        inside the runtime directory of the user.
+    """
+    path = os.environ.get("MIMEFIELD_SOCKET")
+    if path:
+        return path
+
+    directory = os.environ.get("XDG_RUNTIME_DIR")
+    if directory and os.path.isdir(directory):
+        return os.path.join(directory, "mimefield.sock")
+    if hasattr(os, "getuid"):
+        return os.path.join(tempfile.gettempdir(),
+                            f"mimefield-{os.getuid()}.sock")
+
+    return os.path.join(tempfile.gettempdir(), "mimefield.sock")
+
+
+def read_frame(sock):
+    """
+        Read a single length-prefixed frame from a socket or return 'None'
+        if the connection was closed before.
+    """
+    prefix = __read(sock, __length.size)
+    if prefix is None:
+        return None
+
+    length = __length.unpack(prefix)[0]
+    if length > FRAME_SIZE:
+        raise ValueError("The frame exceeds the maximum frame size")
+    data = __read(sock, length)
+    if data is None:
+        raise ConnectionError("The connection was closed within a frame")
+
+    return data
+
+
+def write_frame(sock, data):
+    """
+        Write a single length-prefixed frame to a socket.
+    """
+    if len(data) > FRAME_SIZE:
+        raise ValueError("The frame exceeds the maximum frame size")
+
+    sock.sendall(__length.pack(len(data)) + data)
+
+
+def __get_peer_uid(sock, socket_path):
+    """
+        Get the ID of the user running the process at the other end of a
+        connected socket or, if the system does not tell, of the owner of
+        the socket file.
+    """
+    if hasattr(socket, "SO_PEERCRED"):
+        credentials = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                      __credentials.size)
+        pid, uid, gid = __credentials.unpack(credentials)
+        return uid
+
+    return os.stat(socket_path).st_uid
+
+
+def __read(sock, size):
+    """
+        Read exactly the given number of bytes from a socket or return
+        'None' if the connection was closed before any of them were read.
+    """
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            if data:
+                raise ConnectionError("The connection was closed within a "
+                                      "frame")
+            return None
+        data += chunk
+
+    return data
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#
+# MIMEfield - MIME type mismatch detection tool
+# Daemon core module
+# Copyright (c) 2022 by Ralf Kilian
+# Distributed under the MIT License (https://opensource.org/licenses/MIT)
+#
+# GitHub: https://github.com/urbanware-org/mimefield
+# GitLab: https://gitlab.com/urbanware-org/mimefield
+#
+
+import os
+import socket
+import socketserver
+import threading
+
+from . import client
+from . import main
+
+
+class DetectionHandler(socketserver.BaseRequestHandler):
+    """
+        Handler of a single client connection, answering its requests until
+        it closes the connection. Each request consists of the method and
+        the absolute path of a file separated by a null character, each
+        response of either '+' followed by the type string or '-' followed
+        by an error message.
+    """
+
+    def handle(self):
+        self.request.settimeout(client.TIMEOUT)
+        while True:
+            try:
+                request = client.read_frame(self.request)
+            except (OSError, ValueError):
+                return
+            if request is None:
+                return
+
+            method, separator, path = request.partition(b"\0")
+            try:
+                if not separator:
+                    raise ValueError("The request is invalid")
+                ftype = self.server.get_mime_type(method.decode("ascii"),
+                                                  os.fsdecode(path))
+                response = b"+" + (ftype or "").encode("utf-8")
+            except Exception as e:
+                response = b"-" + str(e).encode("utf-8", errors="replace")
+
+            try:
+                client.write_frame(self.request, response)
+            except OSError:
+                return
+
+
+class DetectionServer(socketserver.ThreadingMixIn,
+                      socketserver.UnixStreamServer):
+    """
+        Detection daemon serving MIME type lookups over a Unix domain socket.
+        The detectors (such as the loaded magic database) are kept in a pool
+        per method, so they stay loaded for all clients.
+    """
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, socket_path=None):
+        if socket_path is None:
+            socket_path = client.get_socket_path()
+
+        self.socket_path = socket_path
+        self.__lock = threading.Lock()
+        self.__idle = {method: [] for method in client.METHODS}
+        self.__detectors = []
+
+        # A socket left behind by a daemon which has not been stopped
+        # properly is replaced, a socket of a running one is not. Neither
+        # is one of another user, which the clients would not connect to
+        if os.path.lexists(socket_path):
+            if hasattr(os, "getuid") and \
+                    os.lstat(socket_path).st_uid != os.getuid():
+                raise RuntimeError(f"The socket '{socket_path}' belongs to "
+                                   f"another user")
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                try:
+                    probe.connect(socket_path)
+                except OSError:
+                    os.remove(socket_path)
+                else:
+                    raise RuntimeError("The detection daemon is already "
+                                       "running")
+
+        # Only the user running the daemon may connect to it, as it reads
+        # any file the user is allowed to read
+        umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.__init__(self, socket_path,
+                                                   DetectionHandler)
+        finally:
+            os.umask(umask)
+
+    def get_mime_type(self, method, path):
+        """
+            Get the MIME type of a single file with an idle detector of the
+            given method.
+        """
+        if method not in client.METHODS:
+            raise ValueError(f"The method '{method}' does not exist")
+        if not os.path.isfile(path):
+            raise FileNotFoundError("Path must be a file")
+
+        with self.__lock:
+            if self.__idle[method]:
+                detector = self.__idle[method].pop()
+            else:
+                detector = main.Detector(method)
+                self.__detectors.append(detector)
+        try:
+            return detector.get_mime_type(path)
+        finally:
+            with self.__lock:
+                self.__idle[method].append(detector)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        try:
+            os.remove(self.socket_path)
+        except OSError:
+            pass
+        with self.__lock:
+            for detector in self.__detectors:
+                detector.close()
+            self.__detectors = []
+            self.__idle = {method: [] for method in client.METHODS}
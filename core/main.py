@@ -11,17 +11,91 @@
 # GitLab: https://gitlab.com/urbanware-org/mimefield
 #
 
+import asyncio
+import collections
+import concurrent.futures
+import hashlib
+import heapq
 import os
+import pickle
 import re
 import shutil
+import signal
+import stat
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+
+from . import cache
+from . import common
+from . import mimedb
+from . import signature
 
 try:
     import magic
 except ImportError:
     magic = None
 
+try:
+    import tomllib
+except ImportError:
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+# Limits for the number of files and the total length of their paths (in
+# bytes) passed to a single invocation of the 'file' utility in batch mode
+BATCH_SIZE = 256
+BATCH_LENGTH = 131072
+
+# Number of files (or batches) queued per worker when scanning in parallel
+QUEUE_SIZE = 4
+
+# Number of files passed to a worker process at once (unless in batch mode)
+PROCESS_CHUNK_SIZE = 64
+
+# Executors available for scanning in parallel
+EXECUTORS = ["thread", "process", "asyncio"]
+
+# Number of paths the directory walk hands over to the event loop at once
+WALK_CHUNK_SIZE = 64
+
+# Detection methods which can be combined into a tier ladder, ordered from the
+# cheapest to the most expensive one
+TIERS = ["empty", "signature", "magic", "file"]
+
+# Maximum number of cached files in a row queued before the following results
+# of the detection, so they do not pile up in memory
+CACHE_RUN = 256
+
+# Formats to print the mismatches in
+OUTPUT_FORMATS = ["tree", "plain"]
+
+# Number of mismatches held in memory when sorting them on disk
+SORT_SIZE = 65536
+
+# Maximum number of header prefixes the detectors remember the type strings of
+MEMO_SIZE = 4096
+
+# Structured result of the magic database for a single file
+MagicType = collections.namedtuple("MagicType",
+                                   ["mime_type", "encoding", "description"])
+
+# Result of checking a single file against its expected MIME type strings,
+# with the verdict being either 'match' or 'mismatch'
+FileResult = collections.namedtuple("FileResult",
+                                    ["path", "ftype", "verdict"])
+
+# Result of a scan with the number of matching files, the mismatches (sorted
+# by their paths), whether the scan was stopped at the maximum number of
+# matching files and the number of files identified per tier
+ScanResult = collections.namedtuple("ScanResult",
+                                    ["matches", "mismatches", "limited",
+                                     "tier_counts"])
+
 
 def file_util():
     """
@@ -32,168 +106,2198 @@ def file_util():
     return file_util_path is not None
 
 
-def get_mime_type(path, extension, mimetype, method, ignore_empty=False,
-                  cut_off=False, maximum=0):
+def get_backend(options):
     """
-        Get the MIME type of a single file or all files from a directory and
-        its sub-directories.
+        Get the identity of the detection backend (the options, the 'file'
+        utility and the magic database), so cached type strings can be
+        discarded when it changes.
     """
+    backend = [common.get_version(), repr(options), str(magic is not None)]
+    databases = []
+    if os.environ.get("MAGIC"):
+        databases = os.environ["MAGIC"].split(os.pathsep)
 
-    try:
-        maximum = int(maximum)
-    except ValueError:
-        maximum = 0
+    if file_util():
+        try:
+            output = subprocess.run(['file', '--version'],
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.DEVNULL).stdout
+            output = output.decode("utf-8", errors="replace")
+        except OSError:
+            output = ""
+        backend.append(" ".join(output.split()))
+        for line in output.splitlines():
+            if line.startswith("magic file from ") and not databases:
+                databases = line[len("magic file from "):].split(":")
 
-    if not method:
-        method = "both"
+    # The version of the utility does not change with an updated database,
+    # so the status of the database files is part of the identity
+    for database in databases:
+        for file_path in (database, database + ".mgc"):
+            try:
+                status = os.stat(file_path)
+            except OSError:
+                continue
+            backend.append(f"{file_path}:{status.st_size}:"
+                           f"{status.st_mtime_ns}")
+
+    return "|".join(backend)
+
+
+def get_mime_type(path, extension, mimetype, method, ignore_empty=False,
+                  cut_off=False, maximum=0, batch=False, header_size=0,
+                  verify=False, tiers=None, stats=False, jobs=1,
+                  executor="thread", walk_jobs=1, rules=None, auto=False,
+                  cache_file=None, cache_size=0, incremental=False,
+                  memo_prefix=0, stream=False, external_sort=False,
+                  output_format="tree"):
+    """
+        Scan all files from a directory and its sub-directories for MIME
+        type mismatches using a scanner (see the 'Scanner' class for the
+        options), print the mismatches and exit with the corresponding
+        status. The mismatches are either printed sorted after the scan
+        (optionally sorted on disk) or as soon as they are found.
+    """
+    if not output_format:
+        output_format = "tree"
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"The output format '{output_format}' does not "
+                         "exist")
+    if stream and external_sort:
+        raise ValueError("Streamed mismatches cannot be sorted")
 
     if not os.path.isdir(path):
         raise NotADirectoryError("The given path is not a directory")
 
-    mimetype = re.sub(r'\|+', '|', mimetype).strip('|')
-    files_checked, files_mismatch = __get_mime_types(path, extension,
-                                                     mimetype, method,
-                                                     ignore_empty,
-                                                     maximum)
+    # Only the mismatches are kept (unless streamed or sorted on disk), the
+    # matching files are merely counted
+    with Scanner(extension, mimetype, method, ignore_empty, maximum, batch,
+                 header_size, verify, tiers, jobs, executor, walk_jobs,
+                 rules, auto, cache_file, cache_size, incremental,
+                 memo_prefix) as scanner:
+        if stream or external_sort:
+            mismatches = scanner.iter_mismatches(path)
+            try:
+                if stream:
+                    count = __print_mismatches(mismatches, path, cut_off,
+                                               output_format)
+                else:
+                    runs = __get_runs(mismatches)
+            finally:
+                mismatches.close()
+        else:
+            files_mismatch = scanner.scan(path).mismatches
+    maximum = scanner.maximum
 
-    if maximum != 0 and len(files_checked) >= maximum:
+    if stats:
+        tier_counts = collections.Counter(scanner.tier_counts)
+        memo_misses = tier_counts.pop("memo miss", 0)
+        counts = ", ".join(f"{tier} {count}"
+                           for tier, count in tier_counts.items())
+        print(f"Files identified per tier: {counts or 'none'}")
+        if scanner.memo_prefix > 0:
+            print(f"Header prefix memo: {tier_counts['memo']} hits, "
+                  f"{memo_misses} misses")
+
+    # The streamed mismatches have already been printed, so only the summary
+    # is left
+    if stream:
+        if count == 0:
+            if scanner.limited:
+                print(f"No mismatches found with the given criteria "
+                      f"(limited to {maximum} items).")
+            else:
+                print("No mismatches found with the given criteria.")
+            sys.exit(0)
+        __print_summary(count, maximum)
+        sys.exit(1)
+
+    mismatches = scanner.counts["mismatches"]
+    if scanner.limited:
         print(f"No mismatches found with the given criteria (limited to "
               f"{maximum} items).")
         sys.exit(0)
-    if len(files_mismatch) == 0:
+    if mismatches == 0:
         print("No mismatches found with the given criteria.")
         sys.exit(0)
 
-    print()
-    count = 0
-    files_mismatch.sort()
-    for mismatch in files_mismatch:
-        count += 1
-        file_path = mismatch[0]
-        ftype = mismatch[1].split(",")[0]
-        if cut_off:
-            file_path = \
-                file_path.replace(path, "").strip("/").strip("\\")[:64]
-            ftype = ftype[:64]
-        if count == 1:
-            print("┌─ Type mismatch:")
-        else:
-            print("├─ Type mismatch:")
-        print(f"├──── File:   {file_path}")
-        if count == len(files_mismatch):
-            print(f"└──── Type:   {ftype}")
-        else:
-            print(f"├──── Type:   {ftype}")
-            print("│")
-    print()
+    if external_sort:
+        files_mismatch = __merge_runs(*runs)
+    __print_mismatches(files_mismatch, path, cut_off, output_format)
+    __print_summary(mismatches, maximum)
+    sys.exit(1)
 
-    if count > 1:
-        mismatches = len(files_mismatch)
-        if maximum == 0:
-            print(
-                f"Type mismatches found ({mismatches} in total), see above.")
-        else:
-            if mismatches > maximum:
-                print(f"Type mismatches found ({mismatches} in total, "
-                      f"limited to {maximum} items), see above.")
-            else:
-                print(f"Type mismatches found ({mismatches} in total), "
-                      f"see above.")
+
+async def get_mime_type_async(path, extension, mimetype, method="file",
+                              ignore_empty=False, maximum=0, header_size=0,
+                              concurrency=16, tier_counts=None,
+                              walk_jobs=1, rules=None, auto=False,
+                              scan_cache=None, incremental=False,
+                              memo_prefix=0):
+    """
+        Get the MIME type of all files from a directory and its
+        sub-directories inside an asyncio event loop and return the number
+        of files which match and the mismatches.
+    """
+    if not method:
+        method = "file"
+    if auto and method == "magic":
+        raise ValueError("The automatic mode requires the MIME types, which "
+                         "the 'magic' method does not return")
+    if concurrency < 1:
+        raise ValueError("The concurrency must be at least 1")
+    if method == "file" and memo_prefix > 0:
+        raise ValueError("The 'asyncio' executor does not use the memo with "
+                         "the 'file' method")
+    if incremental and scan_cache is None:
+        raise ValueError("The incremental mode requires a cache")
+    if not os.path.isdir(path):
+        raise NotADirectoryError("The given path is not a directory")
+
+    if tier_counts is None:
+        tier_counts = collections.Counter()
+
+    matches = 0
+    files_mismatch = []
+    rules = get_rules(extension, mimetype, rules, auto)
+    options = (method, ignore_empty, header_size, False, None, memo_prefix)
+    results = __get_results_async(path, rules, options, concurrency,
+                                  tier_counts, walk_jobs, scan_cache,
+                                  incremental)
+    try:
+        async for file_path, ftype in results:
+            if ftype is not None:
+                if match_mime_type(ftype, get_rule(rules, file_path)):
+                    matches += 1
+                else:
+                    files_mismatch.append((file_path, ftype))
+
+            if maximum != 0 and matches == maximum:
+                break
+    finally:
+        await results.aclose()
+
+    return matches, files_mismatch
+
+
+def get_results(path, rules, options, batch, jobs, executor, tier_counts,
+                walk_jobs=1, scan_cache=None, incremental=False,
+                detector=None):
+    """
+        Recursively get the type strings of all files with one of the
+        extensions of the given rules from a directory and its
+        sub-directories in the order of the walk. When scanning serially, an
+        existing detector can be given, which is kept open afterwards.
+    """
+    if executor == "asyncio":
+        # The asynchronous scan neither verifies nor uses tiers
+        method, ignore_empty, header_size, verify, tiers, memo_prefix = \
+            options
+        options = (method, ignore_empty, header_size, False, None,
+                   memo_prefix)
+        yield from __run_async(__get_results_async(path, rules, options,
+                                                   jobs, tier_counts,
+                                                   walk_jobs, scan_cache,
+                                                   incremental))
+        return
+
+    files = __get_files(path, rules, walk_jobs,
+                        scan_cache if incremental else None)
+    if scan_cache is None:
+        results = __detect(options, files, rules, batch, jobs, executor,
+                           tier_counts, detector)
     else:
-        print("Type mismatch found, see above.")
-    sys.exit(1)
+        # The detection results depend on the expected MIME type strings
+        # when verifying or using tiers, so they are part of the cache key
+        pending = collections.deque()
+        misses = __get_misses(scan_cache, files, rules,
+                              bool(options[3] or options[4]), pending)
+        results = __detect_cached(scan_cache,
+                                  __detect(options, misses, rules, batch,
+                                           jobs, executor, tier_counts,
+                                           detector),
+                                  pending, tier_counts)
+    try:
+        yield from results
+    finally:
+        results.close()
+        files.close()
+
+
+def get_rule(rules, path):
+    """
+        Get the MIME type strings of the rule for the longest extension of a
+        file (e.g. '.tar.gz' rather than '.gz') or 'None' if there is none.
+    """
+    # Every extension is a suffix of the file name starting with a dot, so
+    # each rule is a single dictionary lookup instead of comparing the name
+    # with all extensions
+    name = os.path.basename(path)
+    index = name.find(".")
+    while index != -1:
+        mimetype = rules.get(name[index:])
+        if mimetype is not None:
+            return mimetype
+        index = name.find(".", index + 1)
+
+    return None
+
+
+def get_rules(extension=None, mimetype=None, rules=None, auto=False):
+    """
+        Get the dispatch table which maps the file extensions to check to
+        their expected MIME type strings from the given extension and MIME
+        type strings and further rules (e.g. loaded from a rules file). In
+        automatic mode, all extensions from the system MIME database are
+        included, unless given otherwise.
+    """
+    items = []
+    if auto:
+        items.extend(mimedb.get_rules().items())
+    if rules:
+        items.extend(rules.items())
+    if extension or mimetype:
+        if not extension or not mimetype:
+            raise ValueError("Both the extension and the MIME type must be "
+                             "given")
+        items.append((extension, mimetype))
+    if not items:
+        raise ValueError("No extensions to check the MIME type for given")
+
+    table = {}
+    for extension, mimetype in items:
+        if not isinstance(mimetype, str):
+            mimetype = "|".join(mimetype)
+        extension = extension.strip()
+        mimetype = re.sub(r'\|+', '|', mimetype).strip('|')
+        if not extension.strip(".") or not mimetype:
+            raise ValueError(f"The rule for the extension '{extension}' is "
+                             "incomplete")
+        if not extension.startswith("."):
+            extension = "." + extension
+        table[extension] = mimetype
+
+    return table
+
+
+def get_tiers(tiers):
+    """
+        Get the list of tiers from a comma-separated string or a list of
+        tier names.
+    """
+    if not tiers:
+        return None
+    if isinstance(tiers, str):
+        tiers = tiers.split(",")
+
+    tiers = [tier.strip().lower() for tier in tiers if tier.strip()]
+    for tier in tiers:
+        if tier not in TIERS:
+            raise ValueError(f"The tier '{tier}' does not exist")
+
+    return tiers
+
+
+def iter_mismatches(path, extension=None, mimetype=None, **options):
+    """
+        Recursively check all files from a directory and its sub-directories
+        and yield the mismatches as soon as they are found, each of them as
+        a record consisting of the path, the detected type string and the
+        verdict. The further options are those of the 'Scanner' class. The
+        scanner is closed when the consumer stops iterating (or closes the
+        generator), so the scan can be terminated early.
+    """
+    with Scanner(extension, mimetype, **options) as scanner:
+        mismatches = scanner.iter_mismatches(path)
+        try:
+            yield from mismatches
+        finally:
+            mismatches.close()
+
+
+def load_rules(file_path):
+    """
+        Load the extensions and their expected MIME type strings from the
+        'rules' table of a TOML file.
+    """
+    if tomllib is None:
+        raise ImportError("Reading rules files requires Python 3.11 or the "
+                          "'tomli' module")
+    if not os.path.isfile(file_path):
+        raise FileNotFoundError("The given rules file does not exist")
+
+    with open(file_path, "rb") as fh_rules:
+        try:
+            data = tomllib.load(fh_rules)
+        except tomllib.TOMLDecodeError as e:
+            raise ValueError(f"The rules file is invalid ({e})") from e
+
+    rules = data.get("rules")
+    if not isinstance(rules, dict):
+        raise ValueError("The rules file does not contain a 'rules' table")
+    for extension, mimetype in rules.items():
+        if isinstance(mimetype, list):
+            valid = all(isinstance(item, str) for item in mimetype)
+        else:
+            valid = isinstance(mimetype, str)
+        if not valid:
+            raise ValueError(f"The rule for the extension '{extension}' "
+                             "must be a string or a list of strings")
+
+    return rules
+
+
+def match_mime_type(ftype, mimetype):
+    """
+        Check if a type string contains one of the given MIME type strings
+        (separated with pipes, case insensitive).
+    """
+    for mime in mimetype.split("|"):
+        if mime.strip().lower() in ftype.lower():
+            return True
+
+    return False
 
 
-def __get_mime_type(path, method, ignore_empty):
+class FileProcess():
     """
-        Get the MIME type of a single file.
+        Long-lived 'file' utility coprocesses which read the paths of the
+        files to check from their standard input, so the utility does not
+        have to be started again for every file.
     """
-    # The 'file' utility is included in all (or most) Unix-like operating
-    # systems (such as Linux and BSD) by default. However, it does not exist
-    # on Windows operating systems, so the 'libmagic' library is (or must) be
-    # used there.
-    ftype = ""
 
-    if method == "both" or method == "file":
+    def __init__(self, header_size=0):
         if not file_util():
             raise EnvironmentError(
                 "The 'file' utility is not available on this system")
-        proc = subprocess.Popen(['file', '--brief', '--mime-type', path],
-                                stdout=subprocess.PIPE)
-        stdout, stderr = proc.communicate()
-        ftype = stdout.decode("utf-8").replace("\n", "")
 
-        proc = subprocess.Popen(['file', '--brief', path],
-                                stdout=subprocess.PIPE)
-        stdout, stderr = proc.communicate()
-        ftype += "|" + stdout.decode("utf-8").replace("\n", "").split(",")[0]
+        # Limit the number of bytes the utility reads from each file
+        self.__options = []
+        if header_size > 0:
+            self.__options = ['--parameter', f"bytes={header_size}"]
+
+        self.__lock = threading.Lock()
+        self.__proc_mime = None
+        self.__proc_desc = None
+
+    def close(self):
+        """
+            Terminate the coprocesses.
+        """
+        with self.__lock:
+            self.__stop()
+
+    def get_file_type(self, path):
+        """
+            Get the MIME type and the description of a single file with one
+            round trip to the coprocesses.
+        """
+        # The paths are separated by line breaks, so a path containing one
+        # cannot be passed to the coprocesses
+        if "\n" in path:
+            return (self.__run(['--mime-type', path]), self.__run([path]))
+
+        line = os.fsencode(path) + b"\n"
+        with self.__lock:
+            if self.__proc_mime is None:
+                self.__start()
+            try:
+                # Feed both coprocesses before reading any of them, so they
+                # determine the MIME type and description concurrently
+                for proc in (self.__proc_mime, self.__proc_desc):
+                    proc.stdin.write(line)
+                    proc.stdin.flush()
+                mime_type = self.__proc_mime.stdout.readline()
+                description = self.__proc_desc.stdout.readline()
+            except BrokenPipeError:
+                mime_type = description = b""
+
+            if mime_type and description:
+                return (mime_type.decode("utf-8").replace("\n", ""),
+                        description.decode("utf-8").replace("\n", ""))
+
+            # At least one of the coprocesses has terminated unexpectedly,
+            # so restart them with the next file and fall back to separate
+            # processes for this one
+            self.__stop()
+
+        return (self.__run(['--mime-type', path]), self.__run([path]))
 
-    if method == "both" or method == "magic":
+    def get_data_type(self, data):
+        """
+            Get the MIME type and description of in-memory data by passing
+            it to the 'file' utility on its standard input.
+        """
+        return (self.__run(['--mime-type', '-'], data),
+                self.__run(['-'], data))
+
+    def get_file_types(self, paths):
+        """
+            Get the MIME types and descriptions of multiple files with a
+            single invocation of the 'file' utility per output format.
+        """
+        if not paths:
+            return []
+
+        command = ['file', '--no-pad', '--print0', '--separator', ''] + \
+            self.__options
+        procs = [subprocess.Popen(command + args + ['--'] + list(paths),
+                                  stdout=subprocess.PIPE)
+                 for args in (['--mime-type'], [])]
+        results = []
+        for proc in procs:
+            stdout, stderr = proc.communicate()
+            results.append(self.__parse_batch(stdout))
+
+        # Each line consists of the file name (with non-printable characters
+        # escaped) terminated by a null character and the output for that
+        # file, in the order the files were given
+        mime_types, descriptions = results
+        if len(mime_types) != len(paths) or len(descriptions) != len(paths):
+            return [self.get_file_type(path) for path in paths]
+
+        return list(zip(mime_types, descriptions))
+
+    @staticmethod
+    def __parse_batch(stdout):
+        """
+            Split the output of a batch invocation into the output for each
+            file.
+        """
+        output = []
+        for line in stdout.decode("utf-8").split("\n"):
+            if not line:
+                continue
+            name, null, result = line.partition("\0")
+            if not null:
+                return []
+            output.append(result[1:])
+
+        return output
+
+    def __run(self, args, data=None):
+        """
+            Run the 'file' utility once (optionally with the given data on
+            its standard input) and return its output.
+        """
+        stdin = None
+        if data is not None:
+            stdin = subprocess.PIPE
+        proc = subprocess.Popen(['file', '--brief'] + self.__options + args,
+                                stdin=stdin, stdout=subprocess.PIPE)
+        stdout, stderr = proc.communicate(data)
+
+        return stdout.decode("utf-8").replace("\n", "")
+
+    def __start(self):
+        """
+            Start the coprocesses.
+        """
+        # The paths are read as soon as the '--files-from' option is parsed,
+        # so it must be the last one
+        command = ['file', '--brief', '--no-buffer'] + self.__options
+        source = ['--files-from', '-']
+        self.__proc_mime = subprocess.Popen(command + ['--mime-type'] + source,
+                                            stdin=subprocess.PIPE,
+                                            stdout=subprocess.PIPE)
+        self.__proc_desc = subprocess.Popen(command + source,
+                                            stdin=subprocess.PIPE,
+                                            stdout=subprocess.PIPE)
+
+    def __stop(self):
+        """
+            Close the input of the coprocesses and wait for them to exit.
+        """
+        for proc in (self.__proc_mime, self.__proc_desc):
+            if proc is None:
+                continue
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+            proc.stdout.close()
+            proc.wait()
+        self.__proc_mime = None
+        self.__proc_desc = None
+
+
+class MagicCookies():
+    """
+        Magic database cookies (one per set of flags) which are loaded once
+        and kept for as many files as required.
+    """
+
+    def __init__(self):
         if magic is None:
             raise ImportError(
                 "The Python module 'magic' does not seem to be installed")
-        m = magic.open(magic.MAGIC_NONE)
-        m.load()
-        if m.file(path) is not None:
-            output = m.file(path).split(",")[0]
-            if not ftype.endswith(output):
-                if method == "both":
-                    separator = "|"
-                else:
-                    separator = ""
-                ftype += separator + m.file(path).split(",")[0]
-
-    for item in ftype.split("|"):
-        if item == "inode/x-empty" or item == "empty" or item == "":
-            if item == "inode/x-empty":
-                if ignore_empty:
-                    ftype = None
+
+        self.__cookies = {}
+
+    def close(self):
+        """
+            Release the cookies.
+        """
+        for cookie in self.__cookies.values():
+            cookie.close()
+        self.__cookies = {}
+
+    def get_cookie(self, flags):
+        """
+            Return the cookie for the given flags, loading the magic database
+            for it only once.
+        """
+        cookie = self.__cookies.get(flags)
+        if cookie is None:
+            cookie = magic.open(flags)
+            cookie.load()
+            self.__cookies[flags] = cookie
+
+        return cookie
+
+    def get_magic_type(self, path, header=None, mime=True, status=None):
+        """
+            Get the MIME type, encoding and description of a single file,
+            opening it only once. If the header (the first bytes) of the file
+            is given, the file is identified from that instead. Unless 'mime'
+            is set, only the description is determined (and the MIME type and
+            encoding are 'None'), which saves a lookup in the database. The
+            status of the file (without following symbolic links) can be
+            given if it is already known.
+        """
+        cookie_desc = self.get_cookie(magic.MAGIC_NONE)
+        cookie_mime = None
+        if mime:
+            cookie_mime = self.get_cookie(magic.MAGIC_MIME)
+
+        if header is not None:
+            mime_type = None
+            if cookie_mime is not None:
+                mime_type = cookie_mime.buffer(header)
+            description = cookie_desc.buffer(header)
+            return self.__get_magic_type(mime_type, description)
+
+        # Special (and empty) files are identified by their status alone,
+        # which requires the path rather than a descriptor
+        if status is None:
+            try:
+                status = os.lstat(path)
+            except OSError:
+                pass
+        regular = status is not None and stat.S_ISREG(status.st_mode) and \
+            status.st_size > 0
+
+        fd = None
+        if regular:
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except OSError:
+                pass
+
+        mime_type = None
+        if fd is None:
+            if cookie_mime is not None:
+                mime_type = cookie_mime.file(path)
+            description = cookie_desc.file(path)
+        else:
+            # The cookies restore the position of the descriptor after
+            # reading, so it can be passed to both of them
+            try:
+                if cookie_mime is not None:
+                    mime_type = cookie_mime.descriptor(fd)
+                description = cookie_desc.descriptor(fd)
+            finally:
+                os.close(fd)
+
+        return self.__get_magic_type(mime_type, description)
+
+    @staticmethod
+    def __get_magic_type(mime, description):
+        """
+            Build the structured result from the output of the cookies.
+        """
+        mime_type = encoding = None
+        if mime is not None:
+            mime_type, separator, encoding = mime.partition("; charset=")
+            if not separator:
+                encoding = None
+
+        return MagicType(mime_type, encoding, description)
+
+
+class Detector():
+    """
+        MIME type detector that keeps the state of the detection methods
+        (such as the loaded magic database) for as many files as required.
+    """
+
+    def __init__(self, method="both", ignore_empty=False, header_size=0,
+                 verify=False, tiers=None, memo_prefix=0,
+                 memo_size=MEMO_SIZE):
+        if not method:
+            method = "both"
+
+        self.method = method
+        self.ignore_empty = ignore_empty
+        self.header_size = header_size
+        self.verify = verify
+        self.tiers = get_tiers(tiers)
+        self.memo_prefix = memo_prefix
+        self.memo_size = memo_size
+        self.memo_hits = 0
+        self.memo_misses = 0
+        self.tier_counts = collections.Counter()
+        self.__memo = collections.OrderedDict()
+        self.__signatures = {}
+        self.__statuses = None
+        self.__file = None
+        self.__magic = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+            Release the resources held by the detection methods.
+        """
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+        if self.__magic is not None:
+            self.__magic.close()
+            self.__magic = None
+
+    def check(self, path, mimetype):
+        """
+            Check the MIME type of a single file against the expected MIME
+            type strings and return the result or 'None' if the file is
+            ignored (e.g. empty).
+        """
+        ftype = self.get_mime_type(path, mimetype)
+        if ftype is None:
+            return None
+        if match_mime_type(ftype, mimetype):
+            return FileResult(path, ftype, "match")
+
+        return FileResult(path, ftype, "mismatch")
+
+    def check_data(self, data, mimetype, name=None):
+        """
+            Check the MIME type of in-memory data (see 'get_data_type()')
+            against the expected MIME type strings and return the result
+            with the given name (e.g. of an upload) as path or 'None' if the
+            data is ignored (e.g. empty).
+        """
+        ftype = self.get_data_type(data, mimetype)
+        if ftype is None:
+            return None
+        if match_mime_type(ftype, mimetype):
+            return FileResult(name, ftype, "match")
+
+        return FileResult(name, ftype, "mismatch")
+
+    def get_data_type(self, data, mimetype=None):
+        """
+            Get the MIME type of in-memory data (bytes, a memoryview or a
+            readable binary file object such as an upload) from its header
+            alone, without writing it to a file. Verification and the tiers
+            apply the same way as for files.
+        """
+        header = self.read_data(data)
+        ftype = self.__verify(None, mimetype, header)
+        if ftype is not None:
+            self.tier_counts["verify"] += 1
+            return ftype
+
+        if self.tiers:
+            ftype, tier = self.__get_tiered(None, mimetype, header)
+            self.tier_counts[tier] += 1
+            return ftype
+
+        # Unlike the magic database and the signatures, the 'file' utility
+        # has to be started for each header, which takes considerably longer
+        file_type = None
+        if self.method == "both" or self.method == "file":
+            file_type = self.__get_file().get_data_type(header)
+        elif self.method == "signature":
+            file_type = signature.get_header_type(header)
+
+        self.tier_counts[self.method] += 1
+        return self.__get_type(None, file_type, header)
+
+    def get_mime_type(self, path, mimetype=None):
+        """
+            Get the MIME type of a single file. In case verification is
+            enabled and the expected MIME type strings are given, the header
+            of the file is checked against the signatures of the expected
+            formats first, so the file only has to be identified if it does
+            not match them.
+        """
+        # The status of the file is only determined once for all methods
+        # requiring it while the file is identified
+        statuses = self.__statuses
+        if statuses is None:
+            self.__statuses = {}
+        try:
+            key = self.__get_memo_key(path, mimetype)
+            ftype = self.__get_memo(key)
+            if ftype is None:
+                ftype = self.__identify(path, mimetype)
+                self.__set_memo(key, ftype)
+        finally:
+            self.__statuses = statuses
+
+        return ftype
+
+    def get_mime_types(self, paths, mimetypes=None):
+        """
+            Get the MIME types of multiple files, passing those which have to
+            be identified to the 'file' utility all at once. The expected
+            MIME type strings can be given for each file or for all of them.
+        """
+        if mimetypes is None or isinstance(mimetypes, str):
+            mimetypes = [mimetypes] * len(paths)
+        if self.tiers or (self.method != "both" and self.method != "file"):
+            return [self.get_mime_type(path, mimetype)
+                    for path, mimetype in zip(paths, mimetypes)]
+
+        statuses = self.__statuses
+        if statuses is None:
+            self.__statuses = {}
+        try:
+            return self.__get_batch_types(paths, mimetypes)
+        finally:
+            self.__statuses = statuses
+
+    def get_type(self, path, file_type):
+        """
+            Get the type string of a single file from the MIME type and
+            description the 'file' utility returned for it elsewhere (e.g.
+            inside an event loop).
+        """
+        return self.__get_type(path, file_type)
+
+    def read_data(self, data, size=None):
+        """
+            Read the header (the first bytes up to the given size, by default
+            the header size or the size of the signature header) of in-memory
+            data. The position of a seekable file object is restored
+            afterwards, so the data can still be processed as a whole.
+        """
+        if size is None:
+            size = self.header_size or signature.HEADER_SIZE
+
+        if hasattr(data, "read"):
+            position = None
+            if hasattr(data, "seekable") and data.seekable():
+                position = data.tell()
+            header = b""
+            while len(header) < size:
+                chunk = data.read(size - len(header))
+                if not chunk:
+                    break
+                if isinstance(chunk, str):
+                    raise TypeError("The file object must be opened in "
+                                    "binary mode")
+                header += chunk
+            if position is not None:
+                data.seek(position)
+            return header
+
+        # Memoryviews of other formats (e.g. arrays of integers) are read as
+        # raw bytes
+        view = memoryview(data)
+        if view.ndim != 1 or view.itemsize != 1:
+            view = view.cast("B")
+
+        return view[:size].tobytes()
+
+    def read_header(self, path, size=None):
+        """
+            Read the header (the first bytes up to the given size, by default
+            the header size) of a single file, so it can be shared by the
+            detection methods.
+        """
+        # Special and empty files are identified by their status, so there
+        # is no header to read from them
+        if size is None:
+            size = self.header_size
+        if size <= 0:
+            return None
+        status = self.__get_status(path)
+        if status is None or not stat.S_ISREG(status.st_mode) or \
+                status.st_size == 0:
+            return None
+        try:
+            with open(path, "rb") as fh:
+                return fh.read(size)
+        except OSError:
+            return None
+
+    def __get_batch_types(self, paths, mimetypes):
+        """
+            Get the MIME types of multiple files with the 'file' utility,
+            passing those which have to be identified to it all at once.
+        """
+        keys = []
+        ftypes = []
+        firsts = {}
+        duplicates = {}
+        for index, (path, mimetype) in enumerate(zip(paths, mimetypes)):
+            key = self.__get_memo_key(path, mimetype)
+            ftype = None
+            if key is not None and key in firsts:
+                # Files sharing the same prefix within a batch are only
+                # identified once as well
+                duplicates[index] = firsts[key]
+                self.memo_hits += 1
+                self.tier_counts["memo"] += 1
             else:
-                if ignore_empty:
-                    ftype = None
+                ftype = self.__get_memo(key)
+                if ftype is None:
+                    ftype = self.__verify(path, mimetype)
+                    if ftype is not None:
+                        self.tier_counts["verify"] += 1
+                        self.__set_memo(key, ftype)
+                    elif key is not None:
+                        firsts[key] = index
+            keys.append(key)
+            ftypes.append(ftype)
+
+        unverified = [path for index, path in enumerate(paths)
+                      if ftypes[index] is None and index not in duplicates]
+        self.tier_counts[self.method] += len(unverified)
+        file_types = iter(self.__get_file().get_file_types(unverified))
+        for index, path in enumerate(paths):
+            if ftypes[index] is None and index not in duplicates:
+                ftypes[index] = self.__get_type(path, next(file_types))
+                self.__set_memo(keys[index], ftypes[index])
+        for index, first in duplicates.items():
+            ftypes[index] = ftypes[first]
+
+        return ftypes
+
+    def __get_memo(self, key):
+        """
+            Get the type string remembered for the given header prefix key
+            or 'None' if there is none.
+        """
+        if key is None:
+            return None
+
+        ftype = self.__memo.get(key)
+        if ftype is None:
+            self.memo_misses += 1
+            self.tier_counts["memo miss"] += 1
+            return None
+
+        self.__memo.move_to_end(key)
+        self.memo_hits += 1
+        self.tier_counts["memo"] += 1
+        return ftype
+
+    def __get_memo_key(self, path, mimetype):
+        """
+            Get the key to remember the type string of a single file by,
+            consisting of the hash of its header prefix and its size class.
+        """
+        if self.memo_prefix <= 0:
+            return None
+        status = self.__get_status(path)
+        if status is None or not stat.S_ISREG(status.st_mode) or \
+                status.st_size == 0:
+            return None
+        try:
+            with open(path, "rb") as fh:
+                prefix = fh.read(self.memo_prefix)
+        except OSError:
+            return None
+
+        # Files sharing the same prefix only get the same key within the
+        # same order of magnitude of their size. When verifying or using
+        # tiers, the type string depends on the expected MIME type as well.
+        digest = hashlib.blake2b(prefix, digest_size=16).digest()
+        if not self.verify and not self.tiers:
+            mimetype = None
+
+        return digest, status.st_size.bit_length(), mimetype
+
+    def __get_status(self, path):
+        """
+            Get the status of a single file (without following symbolic
+            links) or 'None' if it cannot be determined. While a file is
+            identified, its status is only determined once.
+        """
+        if self.__statuses is not None and path in self.__statuses:
+            return self.__statuses[path]
+        try:
+            status = os.lstat(path)
+        except OSError:
+            status = None
+        if self.__statuses is not None:
+            self.__statuses[path] = status
+
+        return status
+
+    def __identify(self, path, mimetype):
+        """
+            Identify a single file using the verification, the tiers or the
+            detection method.
+        """
+        ftype = self.__verify(path, mimetype)
+        if ftype is not None:
+            self.tier_counts["verify"] += 1
+            return ftype
+
+        if self.tiers:
+            ftype, tier = self.__get_tiered(path, mimetype)
+            self.tier_counts[tier] += 1
+            return ftype
+
+        # The 'file' utility is included in all (or most) Unix-like operating
+        # systems (such as Linux and BSD) by default. However, it does not
+        # exist on Windows operating systems, so the 'libmagic' library is
+        # (or must) be used there.
+        file_type = None
+        if self.method == "both" or self.method == "file":
+            file_type = self.__get_file().get_file_type(path)
+        elif self.method == "signature":
+            header = self.read_header(path, self.header_size or
+                                      signature.HEADER_SIZE)
+            file_type = signature.get_file_type(path, header,
+                                                self.__get_status(path))
+
+        self.tier_counts[self.method] += 1
+        return self.__get_type(path, file_type)
+
+    def __set_memo(self, key, ftype):
+        """
+            Remember the type string of a single file by its header prefix
+            key, forgetting the least recently used one if the memo is full.
+        """
+        if key is None or ftype is None:
+            return
+
+        self.__memo[key] = ftype
+        self.__memo.move_to_end(key)
+        if len(self.__memo) > self.memo_size:
+            self.__memo.popitem(last=False)
+
+    def __get_tiered(self, path, mimetype, header=None):
+        """
+            Get the MIME type of a single file (or the given header of
+            in-memory data without a path) with the tiers in the given
+            order, stopping as soon as a tier found a match with the expected
+            MIME type strings or confidently found a different type. Return
+            the type string and the name of the tier which decided.
+        """
+        answer = (None, None)
+        for number, tier in enumerate(self.tiers):
+            last = number == len(self.tiers) - 1
+            if tier != "empty" and tier != "file" and header is None:
+                header = self.read_header(path, self.header_size or
+                                          signature.HEADER_SIZE)
+
+            file_type, confident = self.__get_tier_type(tier, path, header,
+                                                        last)
+            if file_type is None:
+                continue
+
+            mime_type, description = file_type
+            ftype = mime_type + "|" + description.partition(",")[0]
+            answer = (ftype, tier)
+            if mimetype and match_mime_type(ftype, mimetype):
+                break
+            if confident:
+                break
+
+        ftype, tier = answer
+        if ftype is None:
+            # No tier was able to identify the file, so the last one has the
+            # final say
+            return self.__get_tiered_last(path, header), self.tiers[-1]
+
+        return self.__get_empty(ftype), tier
+
+    def __get_tiered_last(self, path, header=None):
+        """
+            Identify a single file (or the given header of in-memory data
+            without a path) with the last tier regardless of how confident
+            it is.
+        """
+        # The last tier reads as much of a file as it requires on its own
+        if path is not None:
+            header = None
+
+        tier = self.tiers[-1]
+        if tier == "empty" and path is None:
+            file_type = signature.get_header_type(header)
+        elif tier == "empty":
+            file_type = signature.get_file_type(path, None,
+                                                self.__get_status(path))
+        else:
+            file_type = self.__get_tier_type(tier, path, header, True)[0]
+
+        mime_type, description = file_type
+        return self.__get_empty(mime_type + "|" +
+                                description.partition(",")[0])
+
+    def __get_tier_type(self, tier, path, header, last):
+        """
+            Get the MIME type and description of a single file (or the
+            given header of in-memory data without a path) from a tier and
+            whether the tier is confident about it. Return 'None' as type in
+            case the tier is not able to identify the file.
+        """
+        if tier == "empty" and path is None:
+            if header:
+                return None, False
+            return ("inode/x-empty", "empty"), True
+        if tier == "empty":
+            status = self.__get_status(path)
+            if status is None:
+                return None, False
+            if stat.S_ISREG(status.st_mode) and status.st_size == 0:
+                return ("inode/x-empty", "empty"), True
+            return None, False
+
+        if tier == "signature":
+            if path is None and last:
+                return signature.get_header_type(header), True
+            if path is not None and (last or header is None):
+                return signature.get_file_type(path, header,
+                                               self.__get_status(path)), True
+            file_type = signature.get_signature_type(header)
+            if file_type is None:
+                return None, False
+            return file_type, file_type[0] not in signature.GENERIC_TYPES
+
+        if tier == "magic":
+            if self.header_size <= 0 and path is not None:
+                header = None
+            status = None
+            if path is not None and header is None:
+                status = self.__get_status(path)
+            magic_type = self.__get_magic().get_magic_type(path, header,
+                                                           status=status)
+            if magic_type.mime_type is None or \
+                    magic_type.description is None:
+                return None, False
+            file_type = (magic_type.mime_type, magic_type.description)
+            return file_type, \
+                file_type[0] not in signature.GENERIC_TYPES or last
+
+        if path is None:
+            return self.__get_file().get_data_type(header), True
+        return self.__get_file().get_file_type(path), True
+
+    def __verify(self, path, mimetype, header=None):
+        """
+            Check the header of a single file (or the given header of
+            in-memory data) against the signatures of the expected formats
+            and return its type string if it matches.
+        """
+        if not self.verify or not mimetype:
+            return None
+
+        compiled = self.__signatures.get(mimetype)
+        if compiled is None:
+            compiled = signature.compile_signatures(mimetype)
+            self.__signatures[mimetype] = compiled
+        if not compiled[1]:
+            return None
+
+        if header is None:
+            header = self.read_header(path, self.header_size or
+                                      signature.HEADER_SIZE)
+        if header is None:
+            return None
+
+        file_type = signature.verify_signature(header, compiled)
+        if file_type is None:
+            return None
+
+        mime_type, description = file_type
+        return mime_type + "|" + description.partition(",")[0]
+
+    def __get_type(self, path, file_type, header=None):
+        """
+            Build the type string of a single file (or the given header of
+            in-memory data without a path) from the output of the 'file'
+            utility or the signatures (if any) and the magic database.
+        """
+        method = self.method
+        ftype = ""
+
+        if file_type is not None:
+            mime_type, description = file_type
+            ftype = mime_type + "|" + description.split(",")[0]
+
+        if method == "both" or method == "magic":
+            status = None
+            if path is not None:
+                header = self.read_header(path)
+                if header is None:
+                    status = self.__get_status(path)
+            output = self.__get_magic().get_magic_type(path, header, False,
+                                                       status).description
+            if output is not None:
+                output = output.partition(",")[0]
+                if not ftype.endswith(output):
+                    if method == "both":
+                        separator = "|"
+                    else:
+                        separator = ""
+                    ftype += separator + output
+
+        return self.__get_empty(ftype)
+
+    def __get_empty(self, ftype):
+        """
+            Replace the type string of an empty file, so it is either ignored
+            or marked as such.
+        """
+        for item in ftype.split("|"):
+            if item == "inode/x-empty" or item == "empty" or item == "":
+                if item == "inode/x-empty":
+                    if self.ignore_empty:
+                        ftype = None
                 else:
-                    ftype = "(empty)"
+                    if self.ignore_empty:
+                        ftype = None
+                    else:
+                        ftype = "(empty)"
+
+        return ftype
+
+    def __get_file(self):
+        """
+            Return the 'file' utility coprocesses, starting them only once.
+        """
+        if self.__file is None:
+            self.__file = FileProcess(self.header_size)
+
+        return self.__file
+
+    def __get_magic(self):
+        """
+            Return the magic database cookies, loading them only once.
+        """
+        if self.__magic is None:
+            self.__magic = MagicCookies()
 
-    return ftype
+        return self.__magic
 
 
-def __get_mime_types(path, extension, mimetype, method, ignore_empty,
-                     maximum):
+class Scanner():
     """
-        Recursively get the MIME type of all files from a directory and its
-        sub-directories.
+        MIME type mismatch scanner that keeps its rules, the cache and the
+        detector (such as the loaded magic database) for as many scans as
+        required and returns the results instead of printing them.
+
+        Further extensions and their expected MIME type strings can be given
+        as rules (e.g. loaded from a rules file) or taken from the system
+        MIME database, so they are all checked in a single pass. With a
+        cache file, the type strings of unchanged files are taken from the
+        previous scans and in incremental mode, so are the listings of
+        unchanged directories. With a memo prefix, files sharing the same
+        header prefix are only identified once.
     """
-    files_checked = []
-    files_mismatch = []
-    is_maximum = False
 
-    if not extension.startswith("."):
-        extension = "." + extension
+    def __init__(self, extension=None, mimetype=None, method="both",
+                 ignore_empty=False, maximum=0, batch=False, header_size=0,
+                 verify=False, tiers=None, jobs=1, executor="thread",
+                 walk_jobs=1, rules=None, auto=False, cache_file=None,
+                 cache_size=0, incremental=False, memo_prefix=0):
+        try:
+            maximum = int(maximum)
+        except ValueError:
+            maximum = 0
 
-    for root, subdirs, files in os.walk(path):
-        for item in files:
-            if not item.endswith(extension):
-                continue
+        try:
+            jobs = int(jobs)
+        except ValueError:
+            jobs = 1
+        if jobs < 1:
+            raise ValueError("The number of jobs must be at least 1")
+        try:
+            walk_jobs = int(walk_jobs)
+        except ValueError:
+            walk_jobs = 1
+        if walk_jobs < 1:
+            raise ValueError("The number of walk jobs must be at least 1")
 
-            file_path = os.path.join(root, item)
-            ftype = __get_mime_type(file_path, method, ignore_empty)
-            if ftype is not None:
-                mismatch = True
-                for mime in mimetype.split("|"):
-                    if mime.strip().lower() in ftype.lower():
-                        mismatch = False
-                        break
-
-                if mismatch:
-                    files_mismatch.append([file_path, ftype])
+        if not executor:
+            executor = "thread"
+        if executor not in EXECUTORS:
+            raise ValueError(f"The executor '{executor}' does not exist")
+
+        try:
+            header_size = int(header_size)
+        except ValueError:
+            header_size = 0
+        if header_size < 0:
+            raise ValueError("The header size must not be negative")
+
+        try:
+            memo_prefix = int(memo_prefix)
+        except ValueError:
+            memo_prefix = 0
+        if memo_prefix < 0:
+            raise ValueError("The memo prefix length must not be negative")
+
+        if not method:
+            method = "both"
+        if auto and method == "magic":
+            raise ValueError("The automatic mode requires the MIME types, "
+                             "which the 'magic' method does not return")
+
+        tiers = get_tiers(tiers)
+        if executor == "asyncio":
+            if batch or verify or tiers:
+                raise ValueError("The 'asyncio' executor supports neither "
+                                 "the batch mode nor verifying nor tiers")
+            if method == "file" and memo_prefix > 0:
+                raise ValueError("The 'asyncio' executor does not use the "
+                                 "memo with the 'file' method")
+
+        try:
+            cache_size = int(cache_size)
+        except ValueError:
+            cache_size = 0
+        if cache_size < 0:
+            raise ValueError("The cache size must not be negative")
+        if incremental and not cache_file:
+            raise ValueError("The incremental mode requires a cache file")
+
+        self.rules = get_rules(extension, mimetype, rules, auto)
+        self.options = (method, ignore_empty, header_size, verify, tiers,
+                        memo_prefix)
+        self.maximum = maximum
+        self.batch = batch
+        self.jobs = jobs
+        self.executor = executor
+        self.walk_jobs = walk_jobs
+        self.incremental = incremental
+        self.memo_prefix = memo_prefix
+        self.counts = collections.Counter()
+        self.tier_counts = collections.Counter()
+        self.__detector = None
+        self.__cache = None
+        if cache_file:
+            self.__cache = cache.ScanCache(cache.get_cache_path(cache_file),
+                                           get_backend(self.options),
+                                           cache_size or cache.CACHE_SIZE)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def limited(self):
+        """
+            Whether the current (or last) scan was stopped at the maximum
+            number of matching files.
+        """
+        return self.maximum != 0 and self.counts["matches"] >= self.maximum
+
+    def close(self):
+        """
+            Release the detector and close the cache.
+        """
+        if self.__detector is not None:
+            self.__detector.close()
+            self.__detector = None
+        if self.__cache is not None:
+            self.__cache.close()
+            self.__cache = None
+
+    def iter_results(self, path):
+        """
+            Recursively check all files with one of the extensions of the
+            rules from a directory and its sub-directories and yield their
+            results in the order of the walk, until the maximum number of
+            matching files is reached. The number of matching files and
+            mismatches as well as the number of files identified per tier are
+            counted for the current scan, so only one scan can be run at a
+            time.
+        """
+        if not os.path.isdir(path):
+            raise NotADirectoryError("The given path is not a directory")
+
+        # The detector is kept for further scans, whereas the workers of a
+        # parallel scan only exist for a single one
+        if self.jobs == 1 and self.executor != "asyncio" and \
+                self.__detector is None:
+            self.__detector = Detector(*self.options)
+
+        self.counts.clear()
+        self.tier_counts.clear()
+        results = get_results(path, self.rules, self.options, self.batch,
+                              self.jobs, self.executor, self.tier_counts,
+                              self.walk_jobs, self.__cache, self.incremental,
+                              self.__detector)
+        try:
+            for file_path, ftype in results:
+                if ftype is not None:
+                    if match_mime_type(ftype, get_rule(self.rules,
+                                                       file_path)):
+                        self.counts["matches"] += 1
+                        yield FileResult(file_path, ftype, "match")
+                    else:
+                        self.counts["mismatches"] += 1
+                        yield FileResult(file_path, ftype, "mismatch")
+
+                if self.maximum != 0 and \
+                        self.counts["matches"] == self.maximum:
+                    break
+        finally:
+            results.close()
+            if self.__cache is not None:
+                self.__cache.flush()
+
+    def iter_mismatches(self, path):
+        """
+            Recursively check all files with one of the extensions of the
+            rules from a directory and its sub-directories and yield only the
+            mismatches as soon as they are found. The scan is stopped and its
+            resources are released as soon as the consumer stops iterating
+            (or closes the generator).
+        """
+        results = self.iter_results(path)
+        try:
+            for result in results:
+                if result.verdict == "mismatch":
+                    yield result
+        finally:
+            results.close()
+
+    def scan(self, path):
+        """
+            Recursively check all files with one of the extensions of the
+            rules from a directory and its sub-directories and return the
+            result of the scan. Only the mismatches are kept, the matching
+            files are merely counted.
+        """
+        mismatches = sorted(self.iter_mismatches(path))
+
+        return ScanResult(self.counts["matches"], mismatches, self.limited,
+                          collections.Counter(self.tier_counts))
+
+
+def __detect(options, paths, rules, batch, jobs, executor, tier_counts,
+             detector=None):
+    """
+        Get the MIME type of the given files either one by one or in batches,
+        in parallel if multiple jobs are given. A given detector is used for
+        the serial detection instead of a new one and is not closed.
+    """
+    if jobs > 1:
+        yield from __detect_parallel(options, paths, rules, batch, jobs,
+                                     executor, tier_counts)
+        return
+
+    owned = detector is None
+    if owned:
+        detector = Detector(*options)
+    try:
+        for files in __get_chunks(paths, batch):
+            mimetypes = __get_rules(rules, files)
+            yield from zip(files, __detect_chunk(detector, files, mimetypes,
+                                                 batch))
+    finally:
+        tier_counts.update(detector.tier_counts)
+        detector.tier_counts.clear()
+        if owned:
+            detector.close()
+
+
+async def __detect_async(options, paths, rules, concurrency, tier_counts):
+    """
+        Get the MIME type of the given files inside an event loop with up to
+        the given number of detections in flight. In case of the 'file'
+        method, the utility is run asynchronously, otherwise the detectors
+        are used from a pool of threads. The results are returned in the
+        order of the files.
+    """
+    loop = asyncio.get_running_loop()
+    detectors = []
+    pool = None
+    detector = Detector(*options)
+    if detector.method == "file":
+        if not file_util():
+            raise EnvironmentError(
+                "The 'file' utility is not available on this system")
+        file_options = []
+        if detector.header_size > 0:
+            file_options = ['--parameter', f"bytes={detector.header_size}"]
+    else:
+        pool = concurrent.futures.ThreadPoolExecutor(
+            concurrency, initializer=__init_worker,
+            initargs=(options, detectors))
+
+    pending = collections.deque()
+    try:
+        async for file_path in paths:
+            if file_path is None:
+                task = loop.create_future()
+                task.set_result(None)
+            elif pool is None:
+                task = asyncio.ensure_future(
+                    __get_file_type_async(file_path, file_options))
+            else:
+                task = loop.run_in_executor(pool, __detect_worker,
+                                            [file_path],
+                                            __get_rules(rules, [file_path]),
+                                            False)
+            pending.append((file_path, task))
+
+            # Wait for the oldest detection before starting further ones, so
+            # the walk does not get too far ahead
+            if len(pending) >= concurrency:
+                file_path, task = pending.popleft()
+                yield file_path, __get_result(detector, file_path,
+                                              await task, tier_counts)
+
+        while pending:
+            file_path, task = pending.popleft()
+            yield file_path, __get_result(detector, file_path, await task,
+                                          tier_counts)
+    except GeneratorExit:
+        # The consumer stopped early (e.g. due to the maximum), so let the
+        # detections in flight finish rather than interrupting them
+        await asyncio.gather(*[task for file_path, task in pending],
+                             return_exceptions=True)
+        raise
+    finally:
+        for file_path, task in pending:
+            task.cancel()
+        await asyncio.gather(*[task for file_path, task in pending],
+                             return_exceptions=True)
+        if pool is not None:
+            pool.shutdown(wait=True)
+        for item in detectors:
+            item.close()
+        detector.close()
+
+
+def __detect_cached(scan_cache, results, pending, tier_counts):
+    """
+        Merge the cached files with the results of the detection, keeping
+        the order of the files.
+    """
+    try:
+        for file_path, ftype in results:
+            yield from __get_cached(scan_cache, pending, tier_counts, ftype)
+        yield from __get_cached(scan_cache, pending, tier_counts)
+    finally:
+        results.close()
+
+
+async def __detect_cached_async(scan_cache, results, pending, tier_counts):
+    """
+        Merge the cached files with the results of the asynchronous
+        detection, keeping the order of the files.
+    """
+    try:
+        async for file_path, ftype in results:
+            for item in __get_cached(scan_cache, pending, tier_counts, ftype):
+                yield item
+        for item in __get_cached(scan_cache, pending, tier_counts):
+            yield item
+    finally:
+        await results.aclose()
+
+
+def __detect_chunk(detector, files, mimetypes, batch):
+    """
+        Get the MIME type of a chunk of files, each of them along with its
+        expected MIME type strings.
+    """
+    if files == [None]:
+        return [None]
+    if batch:
+        return detector.get_mime_types(files, mimetypes)
+
+    return [detector.get_mime_type(file_path, mimetype)
+            for file_path, mimetype in zip(files, mimetypes)]
+
+
+def __detect_parallel(options, paths, rules, batch, jobs, executor,
+                      tier_counts):
+    """
+        Get the MIME type of the given files with a pool of threads or
+        processes, each of them using its own detector. The results are
+        returned in the order of the files, so the output does not differ
+        from a serial scan.
+    """
+    detectors = []
+    if executor == "process":
+        # Every process loads the magic database once when it is started
+        # and gets multiple files at once to keep the communication low
+        pool = concurrent.futures.ProcessPoolExecutor(
+            jobs, initializer=__init_worker, initargs=(options,))
+        size = PROCESS_CHUNK_SIZE
+    else:
+        pool = concurrent.futures.ThreadPoolExecutor(
+            jobs, initializer=__init_worker, initargs=(options, detectors))
+        size = 1
+
+    pending = collections.deque()
+    try:
+        # The number of queued chunks is limited, so the directory walk does
+        # not get too far ahead of the workers
+        for files in __get_chunks(paths, batch, size):
+            # Only the expected MIME type strings of the files are passed to
+            # the workers instead of the whole table of rules
+            future = pool.submit(__detect_worker, files,
+                                 __get_rules(rules, files), batch)
+            pending.append((files, future))
+            if len(pending) >= jobs * QUEUE_SIZE:
+                files, future = pending.popleft()
+                ftypes, counts = future.result()
+                tier_counts.update(counts)
+                yield from zip(files, ftypes)
+
+        while pending:
+            files, future = pending.popleft()
+            ftypes, counts = future.result()
+            tier_counts.update(counts)
+            yield from zip(files, ftypes)
+    finally:
+        for files, future in pending:
+            future.cancel()
+        pool.shutdown(wait=True)
+        for detector in detectors:
+            detector.close()
+
+
+def __detect_worker(files, mimetypes, batch):
+    """
+        Get the MIME type of a chunk of files inside a worker and return the
+        type strings with the number of files identified per tier.
+    """
+    detector = __worker.detector
+    ftypes = __detect_chunk(detector, files, mimetypes, batch)
+    counts = dict(detector.tier_counts)
+    detector.tier_counts.clear()
+
+    return ftypes, counts
+
+
+def __init_worker(options, detectors=None):
+    """
+        Create the detector of a worker thread or process.
+    """
+    detector = Detector(*options)
+    __worker.detector = detector
+    if detectors is not None:
+        detectors.append(detector)
+
+
+async def __get_file_type_async(path, options):
+    """
+        Get the MIME type and description of a single file by running the
+        'file' utility asynchronously.
+    """
+    outputs = []
+    procs = []
+    try:
+        for args in (['--mime-type', path], [path]):
+            procs.append(await asyncio.create_subprocess_exec(
+                'file', '--brief', *options, *args,
+                stdout=asyncio.subprocess.PIPE))
+        for proc in procs:
+            stdout, stderr = await proc.communicate()
+            outputs.append(stdout.decode("utf-8").replace("\n", ""))
+    finally:
+        # Do not leave any processes behind when cancelled (e.g. when the
+        # scan was interrupted)
+        for proc in procs:
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+
+    return tuple(outputs)
+
+
+def __get_result(detector, file_path, result, tier_counts):
+    """
+        Get the type string from the result of an asynchronous detection.
+    """
+    if file_path is None:
+        return None
+    if detector.method == "file":
+        tier_counts["file"] += 1
+        return detector.get_type(file_path, result)
+
+    ftypes, counts = result
+    tier_counts.update(counts)
+    return ftypes[0]
+
+
+def __get_cached(scan_cache, pending, tier_counts, ftype=None):
+    """
+        Get the cached files queued before the next identified file followed
+        by that file, storing its type string in the cache.
+    """
+    while pending:
+        file_path, cached_type, status, expected = pending.popleft()
+        if cached_type is None:
+            if status is not None and ftype is not None:
+                scan_cache.set_type(status, ftype, expected)
+            if file_path is not None:
+                yield file_path, ftype
+            return
+
+        tier_counts["cache"] += 1
+        yield file_path, cached_type
+
+
+def __get_chunks(paths, batch, size=1):
+    """
+        Split the given files into batches or chunks of the given size.
+    """
+    if not batch:
+        files = []
+        for file_path in paths:
+            # Markers without a path (passed through the detection when
+            # using the cache) always form a chunk on their own
+            if file_path is None and files:
+                yield files
+                files = []
+            files.append(file_path)
+            if len(files) >= size or file_path is None:
+                yield files
+                files = []
+        if files:
+            yield files
+        return
+
+    files = []
+    length = 0
+    for file_path in paths:
+        if file_path is None:
+            if files:
+                yield files
+            yield [None]
+            files = []
+            length = 0
+            continue
+        files.append(file_path)
+        length += len(os.fsencode(file_path)) + 1
+        if len(files) >= BATCH_SIZE or length >= BATCH_LENGTH:
+            yield files
+            files = []
+            length = 0
+
+    if files:
+        yield files
+
+
+def __get_entries(path, rules):
+    """
+        Recursively get the directory entries of all files with one of the
+        extensions of the given rules from a directory and its
+        sub-directories as soon as they are found.
+    """
+    # The directories are processed in the same order as 'os.walk()' does,
+    # but without collecting all entries of a directory first. The type of
+    # an entry is usually known from the directory listing, so it does not
+    # require a separate system call (except for symbolic links).
+    directories = [path]
+    while directories:
+        directory = directories.pop()
+        subdirs = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+
+                    if is_dir:
+                        if not entry.is_symlink():
+                            subdirs.append(entry.path)
+                    elif get_rule(rules, entry.name) is not None:
+                        yield entry
+        except OSError:
+            continue
+
+        directories.extend(reversed(subdirs))
+
+
+def __get_entries_parallel(path, rules, jobs):
+    """
+        Recursively get the directory entries of all files with one of the
+        extensions of the given rules from a directory and its
+        sub-directories, listing multiple directories in parallel.
+    """
+    # The directories are still processed in the same order as with a
+    # single job, but the listings of the directories to process next are
+    # requested ahead, so multiple of them are in progress at the same time
+    pool = concurrent.futures.ThreadPoolExecutor(jobs)
+    directories = [path]
+    try:
+        while directories:
+            __prefetch_directories(pool, directories, rules,
+                                   jobs * QUEUE_SIZE)
+            listing = directories.pop()
+            files, subdirs = listing.result()
+            yield from files
+            directories.extend(reversed(subdirs))
+    finally:
+        for listing in directories:
+            if isinstance(listing, concurrent.futures.Future):
+                listing.cancel()
+        pool.shutdown(wait=True)
+
+
+def __get_files(path, rules, walk_jobs=1, scan_cache=None):
+    """
+        Recursively get the paths of all files with one of the extensions of
+        the given rules from a directory and its sub-directories. With a
+        cache, the listings of unchanged directories are taken from it.
+    """
+    if scan_cache is not None:
+        yield from __get_files_incremental(path, rules, scan_cache)
+        return
+
+    if walk_jobs > 1:
+        entries = __get_entries_parallel(path, rules, walk_jobs)
+    else:
+        entries = __get_entries(path, rules)
+
+    try:
+        for entry in entries:
+            yield entry.path
+    finally:
+        entries.close()
+
+
+def __get_files_incremental(path, rules, scan_cache):
+    """
+        Recursively get the paths of all files with one of the extensions of
+        the given rules from a directory and its sub-directories, only
+        listing the directories which have changed since the previous scan.
+    """
+    # The directories are processed in the same order as by the walk above,
+    # so the files are the same and in the same order, even if none of the
+    # directories have to be listed again
+    directories = [path]
+    while directories:
+        directory = directories.pop()
+        listing = __list_directory_cached(directory, scan_cache)
+        if listing is None:
+            continue
+
+        files, subdirs = listing
+        for name in files:
+            if get_rule(rules, name) is not None:
+                yield os.path.join(directory, name)
+        directories.extend(os.path.join(directory, name)
+                           for name in reversed(subdirs))
+
+
+def __list_directory(directory, rules):
+    """
+        Get the directory entries of all files with one of the extensions of
+        the given rules and the paths of the sub-directories from a single
+        directory.
+    """
+    files = []
+    subdirs = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+
+                if is_dir:
+                    if not entry.is_symlink():
+                        subdirs.append(entry.path)
+                elif get_rule(rules, entry.name) is not None:
+                    files.append(entry)
+    except OSError:
+        return files, []
+
+    return files, subdirs
+
+
+def __list_directory_cached(directory, scan_cache):
+    """
+        Get the names of all files and sub-directories from a single
+        directory, either from the cache (if its modification time has not
+        changed since) or by listing it.
+    """
+    try:
+        status = os.stat(directory)
+    except OSError:
+        return None
+
+    listing = scan_cache.get_listing(directory, status)
+    if listing is not None:
+        return listing
+
+    # The time is taken before listing the directory, so changes made while
+    # listing it are not missed on the next scan
+    listed_ns = time.time_ns()
+    files = []
+    subdirs = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+
+                if is_dir:
+                    if not entry.is_symlink():
+                        subdirs.append(entry.name)
                 else:
-                    files_checked.append(file_path)
+                    files.append(entry.name)
+    except OSError:
+        return None
+
+    scan_cache.set_listing(directory, status, files, subdirs, listed_ns)
+    return files, subdirs
+
+
+def __prefetch_directories(pool, directories, rules, limit):
+    """
+        Request the listings of the directories to be processed next, up to
+        the given number of listings in progress.
+    """
+    pending = 0
+    for index in range(len(directories) - 1, -1, -1):
+        if pending >= limit:
+            break
+        if isinstance(directories[index], str):
+            directories[index] = pool.submit(__list_directory,
+                                             directories[index], rules)
+        pending += 1
 
-            if len(files_checked) == maximum:
-                is_maximum = True
+
+async def __get_async(items):
+    """
+        Get the items of a generator (such as the paths from the directory
+        walk) inside an event loop, running it in a separate thread so the
+        event loop is not blocked.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            chunk = await loop.run_in_executor(None, __get_next, items,
+                                               WALK_CHUNK_SIZE)
+            if not chunk:
                 break
+            for item in chunk:
+                yield item
+    finally:
+        await loop.run_in_executor(None, items.close)
+
+
+def __get_rules(rules, files):
+    """
+        Get the MIME type strings of the rules for multiple files (or
+        'None' for markers without a path).
+    """
+    mimetypes = []
+    for file_path in files:
+        if file_path is None:
+            mimetypes.append(None)
+        else:
+            mimetypes.append(get_rule(rules, file_path))
+
+    return mimetypes
+
+
+def __get_misses(scan_cache, paths, rules, dependent, pending):
+    """
+        Queue the given files in their order along with their cached type
+        strings and only pass on those which are not cached (or have changed
+        since).
+    """
+    # Only the status of a file is required to look it up, so cached files
+    # are not opened at all. Special files (such as symbolic links) are
+    # identified by their status anyway, so they are not cached.
+    run = 0
+    try:
+        for file_path in paths:
+            expected = ""
+            if dependent:
+                expected = get_rule(rules, file_path)
+            try:
+                status = os.lstat(file_path)
+            except OSError:
+                status = None
+
+            if status is not None and stat.S_ISREG(status.st_mode):
+                ftype = scan_cache.get_type(status, expected)
+                if ftype is not None:
+                    pending.append((file_path, ftype, None, None))
+                    run += 1
+                    if run >= CACHE_RUN:
+                        # Pass a marker without a path through the detection,
+                        # so the cached files queued so far are returned
+                        pending.append((None, None, None, None))
+                        run = 0
+                        yield None
+                    continue
+            else:
+                status = None
+
+            pending.append((file_path, None, status, expected))
+            run = 0
+            yield file_path
+    finally:
+        paths.close()
 
-        if is_maximum:
+
+def __get_next(items, count):
+    """
+        Get up to the given number of items from an iterator.
+    """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= count:
             break
 
-    return files_checked, files_mismatch
+    return chunk
+
+
+async def __get_results_async(path, rules, options, concurrency,
+                              tier_counts, walk_jobs=1, scan_cache=None,
+                              incremental=False):
+    """
+        Recursively get the type strings of all files with one of the
+        extensions of the given rules from a directory and its
+        sub-directories in the order of the walk inside an event loop.
+    """
+    files = __get_files(path, rules, walk_jobs,
+                        scan_cache if incremental else None)
+    if scan_cache is None:
+        files = __get_async(files)
+        results = __detect_async(options, files, rules, concurrency,
+                                 tier_counts)
+    else:
+        pending = collections.deque()
+        files = __get_async(__get_misses(scan_cache, files, rules, False,
+                                         pending))
+        results = __detect_cached_async(
+            scan_cache, __detect_async(options, files, rules, concurrency,
+                                       tier_counts), pending, tier_counts)
+    try:
+        async for item in results:
+            yield item
+    finally:
+        await results.aclose()
+        await files.aclose()
+
+
+def __get_runs(mismatches, size=SORT_SIZE):
+    """
+        Sort the given mismatches in runs of up to the given size, writing
+        all but the last run to temporary files, so only a limited number of
+        mismatches is held in memory.
+    """
+    runs = []
+    items = []
+    try:
+        for mismatch in mismatches:
+            items.append(mismatch)
+            if len(items) >= size:
+                items.sort()
+                run = tempfile.TemporaryFile()
+                runs.append(run)
+                for item in items:
+                    pickle.dump(item, run, pickle.HIGHEST_PROTOCOL)
+                items = []
+    except BaseException:
+        for run in runs:
+            run.close()
+        raise
+
+    items.sort()
+    return runs, items
+
+
+def __merge_runs(runs, items):
+    """
+        Merge the sorted runs written to temporary files and the last run
+        held in memory into a single sorted sequence.
+    """
+    try:
+        yield from heapq.merge(*[__read_run(run) for run in runs], items)
+    finally:
+        for run in runs:
+            run.close()
+
+
+def __print_mismatches(mismatches, path, cut_off=False, output_format="tree"):
+    """
+        Print the given mismatches as soon as they are available and return
+        their number.
+    """
+    # In the tree format, the last mismatch is drawn differently, so each
+    # mismatch is printed as soon as the next one is available
+    count = 0
+    previous = None
+    for mismatch in mismatches:
+        if count == 0:
+            print()
+        count += 1
+        if output_format == "tree":
+            if previous is not None:
+                __print_mismatch(previous, count - 1, False, path, cut_off,
+                                 output_format)
+            previous = mismatch
+        else:
+            __print_mismatch(mismatch, count, False, path, cut_off,
+                             output_format)
+        sys.stdout.flush()
+
+    if previous is not None:
+        __print_mismatch(previous, count, True, path, cut_off, output_format)
+    if count > 0:
+        print()
+
+    return count
+
+
+def __print_mismatch(mismatch, count, last, path, cut_off, output_format):
+    """
+        Print a single mismatch either as a part of the tree or as a plain
+        line.
+    """
+    file_path = mismatch[0]
+    ftype = mismatch[1].split(",")[0]
+    if cut_off:
+        file_path = file_path.replace(path, "").strip("/").strip("\\")[:64]
+        ftype = ftype[:64]
+
+    if output_format == "plain":
+        print(f"{file_path}: {ftype}")
+        return
+
+    if count == 1:
+        print("┌─ Type mismatch:")
+    else:
+        print("├─ Type mismatch:")
+    print(f"├──── File:   {file_path}")
+    if last:
+        print(f"└──── Type:   {ftype}")
+    else:
+        print(f"├──── Type:   {ftype}")
+        print("│")
+
+
+def __print_summary(mismatches, maximum):
+    """
+        Print the summary of the mismatches found.
+    """
+    if mismatches > 1:
+        if maximum == 0:
+            print(
+                f"Type mismatches found ({mismatches} in total), see above.")
+        else:
+            if mismatches > maximum:
+                print(f"Type mismatches found ({mismatches} in total, "
+                      f"limited to {maximum} items), see above.")
+            else:
+                print(f"Type mismatches found ({mismatches} in total), "
+                      f"see above.")
+    else:
+        print("Type mismatch found, see above.")
+
+
+def __read_run(run):
+    """
+        Read the mismatches of a sorted run from a temporary file.
+    """
+    run.seek(0)
+    while True:
+        try:
+            yield pickle.load(run)
+        except EOFError:
+            return
+
+
+def __run_async(results):
+    """
+        Get the items of an asynchronous generator from synchronous code,
+        running it inside its own event loop.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                item = __run_task(loop, results.__anext__())
+            except StopAsyncIteration:
+                break
+            yield item
+    finally:
+        try:
+            __run_task(loop, results.aclose())
+            # Same as with 'asyncio.run()', cancel the tasks still left
+            pending = asyncio.all_tasks(loop)
+            if pending:
+                for task in pending:
+                    task.cancel()
+                loop.run_until_complete(
+                    asyncio.gather(*pending, return_exceptions=True))
+            loop.run_until_complete(loop.shutdown_asyncgens())
+            loop.run_until_complete(loop.shutdown_default_executor())
+        finally:
+            loop.close()
+
+
+def __run_task(loop, awaitable):
+    """
+        Run an awaitable inside an event loop until it is complete. Same as
+        with 'asyncio.run()', an interruption (e.g. with Ctrl+C) cancels it
+        rather than interrupting the event loop itself, so it can finish
+        cleanly before the interruption is raised.
+    """
+    task = asyncio.ensure_future(awaitable, loop=loop)
+    interrupted = False
+
+    def interrupt(signum, frame):
+        nonlocal interrupted
+        # Interrupting twice does not wait for the task any longer
+        if interrupted:
+            raise KeyboardInterrupt()
+        interrupted = True
+        if not task.done():
+            task.cancel()
+            loop.call_soon_threadsafe(lambda: None)
+
+    handler = None
+    if threading.current_thread() is threading.main_thread() and \
+            signal.getsignal(signal.SIGINT) is signal.default_int_handler:
+        handler = signal.signal(signal.SIGINT, interrupt)
+    try:
+        result = loop.run_until_complete(task)
+    except asyncio.CancelledError:
+        if not interrupted:
+            raise
+    finally:
+        if handler is not None:
+            signal.signal(signal.SIGINT, handler)
+
+    if interrupted:
+        raise KeyboardInterrupt()
+    return result
+
+
+__worker = threading.local()
@@ -0,0 +1,448 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#
+# MIMEfield - MIME type mismatch detection tool
+# Upload middleware core module
+# Copyright (c) 2022 by Ralf Kilian
+# Distributed under the MIT License (https://opensource.org/licenses/MIT)
+#
+# GitHub: https://github.com/urbanware-org/mimefield
+# GitLab: https://gitlab.com/urbanware-org/mimefield
+#
+
+import collections
+import email.message
+import email.utils
+import http
+import tempfile
+import threading
+
+from . import main
+from . import mimedb
+from . import signature
+
+# Number of bytes read from the request body at once
+CHUNK_SIZE = 65536
+
+# Number of bytes of a request body held in memory before it is spooled to a
+# temporary file
+SPOOL_SIZE = 1048576
+
+# Maximum size of the headers of a single part, larger ones end the
+# inspection of the request body with an error
+HEADER_LIMIT = 16384
+
+# Key of the WSGI environment (or the ASGI scope) the checked uploads are
+# stored under
+ENVIRON_KEY = "mimefield.uploads"
+
+# Result of checking a single uploaded file, with the verdict being either
+# 'match', 'mismatch' or 'None' if there was nothing to check it against
+Upload = collections.namedtuple("Upload",
+                                ["name", "filename", "content_type", "ftype",
+                                 "verdict"])
+
+
+class UploadChecker():
+    """
+        Checker of the files uploaded with multipart requests, comparing the
+        header of each file with the expected MIME type strings of its
+        extension and the content type declared for it. The detectors (one
+        per thread) are kept for as many requests as required.
+    """
+
+    def __init__(self, extension=None, mimetype=None, rules=None, auto=False,
+                 method="signature", header_size=0, reject=True):
+        if not method:
+            method = "signature"
+        if auto and method == "magic":
+            raise ValueError("The automatic mode requires the MIME types, "
+                             "which the 'magic' method does not return")
+
+        self.rules = main.get_rules(extension, mimetype, rules, auto)
+        self.method = method
+        self.header_size = header_size or signature.HEADER_SIZE
+        self.reject = reject
+        self.__local = threading.local()
+        self.__lock = threading.Lock()
+        self.__detectors = []
+
+    def check(self, name, filename, content_type, header):
+        """
+            Check the header (the first bytes) of a single uploaded file
+            against the expected MIME type strings of its extension and its
+            declared content type (unless either of them is a generic one).
+            Empty files are not checked.
+        """
+        detector = getattr(self.__local, "detector", None)
+        if detector is None:
+            detector = main.Detector(self.method,
+                                     header_size=self.header_size)
+            self.__local.detector = detector
+            with self.__lock:
+                self.__detectors.append(detector)
+
+        ftype = detector.get_data_type(header)
+        # An empty file (such as one of a file field left empty) does not
+        # have any content to check
+        if not header:
+            return Upload(name, filename, content_type, ftype, None)
+
+        # The declared content type can only be compared with a specific
+        # MIME type, as many formats (e.g. JSON or CSV) are only identified
+        # as plain text and the 'magic' method does not return MIME types
+        # at all
+        expected = main.get_rule(self.rules, filename)
+        sniffed = ftype.split("|")[0]
+        if content_type and content_type not in mimedb.IGNORED_TYPES and \
+                self.method != "magic" and \
+                sniffed not in signature.GENERIC_TYPES:
+            declared = "|".join([content_type] +
+                                mimedb.ALIASES.get(content_type, []))
+        else:
+            declared = None
+        if expected is None and declared is None:
+            return Upload(name, filename, content_type, ftype, None)
+
+        verdict = "match"
+        for mimetype in (expected, declared):
+            if mimetype is not None and \
+                    not main.match_mime_type(ftype, mimetype):
+                verdict = "mismatch"
+
+        return Upload(name, filename, content_type, ftype, verdict)
+
+    def close(self):
+        """
+            Release the detectors.
+        """
+        with self.__lock:
+            for detector in self.__detectors:
+                detector.close()
+            self.__detectors = []
+        self.__local = threading.local()
+
+    def get_inspector(self, content_type):
+        """
+            Get the inspector for the body of a request with the given
+            content type or 'None' if it is not a multipart form.
+        """
+        message = email.message.Message()
+        message["Content-Type"] = content_type or ""
+        if message.get_content_type() != "multipart/form-data":
+            return None
+
+        boundary = message.get_param("boundary")
+        if not boundary or not isinstance(boundary, str):
+            return None
+
+        return UploadInspector(self, boundary.encode("latin-1"))
+
+    def get_rejection(self, inspector):
+        """
+            Get the status and the body of the response rejecting a request
+            inspected by the given inspector or 'None' if it is accepted.
+            Requests which could not be inspected completely are rejected as
+            well, so uploads cannot be hidden from the inspection.
+        """
+        if not self.reject:
+            return None
+        if inspector.error is not None:
+            return 400, f"{inspector.error}\n".encode("utf-8")
+
+        mismatches = [upload for upload in inspector.uploads
+                      if upload.verdict == "mismatch"]
+        if mismatches:
+            return 415, self.get_message(mismatches)
+
+        return None
+
+    @staticmethod
+    def get_message(uploads):
+        """
+            Get the body of the response rejecting a request due to the given
+            mismatching uploads.
+        """
+        lines = [f"Type mismatch: {upload.filename} ({upload.ftype})\n"
+                 for upload in uploads]
+
+        return "".join(lines).encode("utf-8")
+
+
+class UploadInspector():
+    """
+        Incremental parser of the body of a multipart request, which keeps
+        only the header of each uploaded file and checks it as soon as the
+        file is complete, so the body is never held in memory as a whole.
+        If the body cannot be inspected completely, the reason is given as
+        error.
+    """
+
+    def __init__(self, checker, boundary):
+        self.uploads = []
+        self.error = None
+        self.__checker = checker
+        self.__delimiter = b"\r\n--" + boundary
+        # The first delimiter is not preceded by a line break
+        self.__buffer = b"\r\n"
+        self.__state = "preamble"
+        self.__part = None
+        self.__header = b""
+
+    def feed(self, data):
+        """
+            Parse the next chunk of the request body.
+        """
+        self.__buffer += data
+        while self.__parse():
+            pass
+
+    def finish(self):
+        """
+            End the inspection after the whole request body has been fed.
+        """
+        if self.__state != "end" and self.error is None:
+            self.error = "The request body ends before the closing delimiter"
+        self.__buffer = b""
+
+    def __add_body(self, data):
+        """
+            Keep the beginning of the body of the current part, if it is an
+            uploaded file.
+        """
+        size = self.__checker.header_size
+        if self.__part is not None and len(self.__header) < size:
+            self.__header += data[:size - len(self.__header)]
+
+    def __end_part(self):
+        """
+            Check the current part, if it is an uploaded file.
+        """
+        if self.__part is not None:
+            name, filename, content_type = self.__part
+            self.uploads.append(self.__checker.check(name, filename,
+                                                     content_type,
+                                                     self.__header))
+        self.__part = None
+        self.__header = b""
+
+    def __parse(self):
+        """
+            Parse as much of the buffered body as possible and return whether
+            there is more to parse.
+        """
+        buffer = self.__buffer
+        if self.__state == "end":
+            self.__buffer = b""
+            return False
+
+        if self.__state == "preamble" or self.__state == "body":
+            index = buffer.find(self.__delimiter)
+            if index == -1:
+                # Keep the end, which may be the beginning of a delimiter
+                keep = len(self.__delimiter) - 1
+                if len(buffer) > keep:
+                    self.__add_body(buffer[:-keep])
+                    self.__buffer = buffer[-keep:]
+                return False
+            self.__add_body(buffer[:index])
+            self.__end_part()
+            self.__buffer = buffer[index + len(self.__delimiter):]
+            self.__state = "boundary"
+            return True
+
+        if self.__state == "boundary":
+            if len(buffer) < 2:
+                return False
+            if buffer.startswith(b"--"):
+                self.__state = "end"
+                return True
+            index = buffer.find(b"\r\n")
+            if index == -1:
+                if len(buffer) > HEADER_LIMIT:
+                    self.__stop("The delimiter line exceeds the limit")
+                return False
+            # The line break is kept, so a part without any headers is
+            # followed by an empty line as well
+            self.__buffer = buffer[index:]
+            self.__state = "headers"
+            return True
+
+        index = buffer.find(b"\r\n\r\n")
+        if index == -1:
+            if len(buffer) > HEADER_LIMIT:
+                self.__stop("The headers of a part exceed the limit")
+            return False
+        self.__start_part(buffer[2:index])
+        self.__buffer = buffer[index + 4:]
+        self.__state = "body"
+        return True
+
+    def __stop(self, error):
+        """
+            Stop the inspection of the request body due to the given error.
+        """
+        self.error = error
+        self.__state = "end"
+        self.__buffer = b""
+
+    def __start_part(self, headers):
+        """
+            Start a new part from its headers, which is only inspected if it
+            is an uploaded file.
+        """
+        message = email.message.Message()
+        for line in headers.split(b"\r\n"):
+            name, separator, value = line.partition(b":")
+            if separator:
+                message[name.decode("latin-1").strip()] = \
+                    value.decode("utf-8", errors="replace").strip()
+
+        filename = message.get_filename()
+        if not filename:
+            return
+
+        content_type = None
+        if "Content-Type" in message:
+            content_type = message.get_content_type()
+        name = message.get_param("name", header="Content-Disposition")
+        if name is not None:
+            name = email.utils.collapse_rfc2231_value(name)
+        self.__part = (name, filename, content_type)
+
+
+class WSGIMiddleware(UploadChecker):
+    """
+        WSGI middleware checking the files uploaded with multipart requests
+        while they are read, either rejecting requests with mismatches or
+        passing the checked uploads on to the application in the
+        environment. The body is spooled to a temporary file once it exceeds
+        the spool size, so it is not held in memory as a whole.
+    """
+
+    def __init__(self, app, extension=None, mimetype=None, rules=None,
+                 auto=False, method="signature", header_size=0,
+                 reject=True):
+        UploadChecker.__init__(self, extension, mimetype, rules, auto,
+                               method, header_size, reject)
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        inspector = self.get_inspector(environ.get("CONTENT_TYPE"))
+        try:
+            length = int(environ.get("CONTENT_LENGTH") or -1)
+        except ValueError:
+            length = -1
+
+        # Without a length, the body can only be read up to its end if the
+        # server terminates the input
+        if inspector is None or \
+                (length < 0 and not environ.get("wsgi.input_terminated")):
+            return self.app(environ, start_response)
+
+        stream = environ["wsgi.input"]
+        spool = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+        while length != 0:
+            if length < 0:
+                chunk = stream.read(CHUNK_SIZE)
+            else:
+                chunk = stream.read(min(CHUNK_SIZE, length))
+                length -= len(chunk)
+            if not chunk:
+                break
+            inspector.feed(chunk)
+            spool.write(chunk)
+        inspector.finish()
+
+        environ["CONTENT_LENGTH"] = str(spool.tell())
+        spool.seek(0)
+        environ["wsgi.input"] = spool
+        environ[ENVIRON_KEY] = inspector.uploads
+
+        rejection = self.get_rejection(inspector)
+        if rejection is not None:
+            spool.close()
+            status, body = rejection
+            start_response(f"{status} {http.HTTPStatus(status).phrase}",
+                           [("Content-Type", "text/plain; charset=utf-8"),
+                            ("Content-Length", str(len(body)))])
+            return [body]
+
+        return self.app(environ, start_response)
+
+
+class ASGIMiddleware(UploadChecker):
+    """
+        ASGI middleware checking the files uploaded with multipart requests
+        while they are received, either rejecting requests with mismatches
+        or passing the checked uploads on to the application in the scope.
+        The body is spooled to a temporary file once it exceeds the spool
+        size, so it is not held in memory as a whole.
+    """
+
+    def __init__(self, app, extension=None, mimetype=None, rules=None,
+                 auto=False, method="signature", header_size=0,
+                 reject=True):
+        UploadChecker.__init__(self, extension, mimetype, rules, auto,
+                               method, header_size, reject)
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        inspector = None
+        if scope["type"] == "http":
+            for name, value in scope.get("headers", []):
+                if name.lower() == b"content-type":
+                    inspector = self.get_inspector(value.decode("latin-1"))
+        if inspector is None:
+            await self.app(scope, receive, send)
+            return
+
+        spool = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message["type"] != "http.request":
+                # The client has disconnected
+                spool.close()
+                return
+            chunk = message.get("body", b"")
+            inspector.feed(chunk)
+            spool.write(chunk)
+            more_body = message.get("more_body", False)
+        inspector.finish()
+        spool.seek(0)
+
+        scope = dict(scope)
+        scope[ENVIRON_KEY] = inspector.uploads
+        rejection = self.get_rejection(inspector)
+        if rejection is not None:
+            spool.close()
+            status, body = rejection
+            await send({"type": "http.response.start", "status": status,
+                        "headers": [(b"content-type",
+                                     b"text/plain; charset=utf-8"),
+                                    (b"content-length",
+                                     str(len(body)).encode("ascii"))]})
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        # The application receives the spooled body in chunks, followed by
+        # the further messages of the client (such as a disconnect)
+        done = False
+
+        async def receive_spooled():
+            nonlocal done
+            if done:
+                return await receive()
+            chunk = spool.read(CHUNK_SIZE)
+            if len(chunk) < CHUNK_SIZE:
+                done = True
+                spool.close()
+            return {"type": "http.request", "body": chunk,
+                    "more_body": not done}
+
+        try:
+            await self.app(scope, receive_spooled, send)
+        finally:
+            spool.close()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#
+# MIMEfield - MIME type mismatch detection tool
+# MIME database core module
+# Copyright (c) 2022 by Ralf Kilian
+# Distributed under the MIT License (https://opensource.org/licenses/MIT)
+#
+# GitHub: https://github.com/urbanware-org/mimefield
+# GitLab: https://gitlab.com/urbanware-org/mimefield
+#
+
+import mimetypes
+import os
+import threading
+
+# MIME types which do not tell anything about the content of a file, so the
+# extensions mapped to them are not checked
+IGNORED_TYPES = ["application/octet-stream"]
+
+# MIME types the 'file' utility and 'libmagic' return for formats that are
+# registered with a different MIME type in the system MIME database
+ALIASES = {
+    "application/java-archive": ["application/zip"],
+    "application/msword": ["application/x-ole-storage"],
+    "application/rtf": ["text/rtf"],
+    "application/vnd.ms-excel": ["application/x-ole-storage"],
+    "application/vnd.ms-powerpoint": ["application/x-ole-storage"],
+    "application/vnd.rar": ["application/x-rar"],
+    "application/x-ruby": ["text/x-ruby"],
+    "application/x-sh": ["text/x-shellscript"],
+    "application/x-sqlite3": ["application/vnd.sqlite3"],
+    "application/xml": ["text/xml"],
+    "image/x-ms-bmp": ["image/bmp"],
+    "text/x-python": ["text/x-script.python"],
+    "text/x-sh": ["text/x-shellscript"],
+    "text/xml": ["application/xml"],
+}
+
+# MIME types of textual formats outside of 'text/*' (besides those ending
+# with '+json' or '+xml'), which the 'file' utility and 'libmagic' return as
+# plain text unless the content is recognized
+TEXT_TYPES = [
+    "application/ecmascript",
+    "application/javascript",
+    "application/json",
+    "application/x-csh",
+    "application/x-javascript",
+    "application/x-sh",
+    "application/x-tex",
+    "application/xml",
+]
+
+# MIME type the 'file' utility and 'libmagic' return for text they do not
+# recognize any further
+PLAIN_TYPE = "text/plain"
+
+
+def get_rules():
+    """
+        Get the expected MIME type strings for all extensions known to the
+        'mimetypes' module and the system MIME database (such as
+        '/etc/mime.types'). The tables are only loaded once.
+    """
+    global __rules
+
+    with __lock:
+        if __rules is None:
+            __rules = __load_rules()
+
+    return __rules
+
+
+def __load_rules():
+    """
+        Load the 'mimetypes' tables and the system MIME database files into
+        a dictionary mapping each extension to its expected MIME type
+        strings.
+    """
+    # Use a separate instance instead of initializing the module, so the
+    # tables of the module stay as they are
+    database = mimetypes.MimeTypes()
+    for file_path in mimetypes.knownfiles:
+        if os.path.isfile(file_path):
+            try:
+                database.read(file_path)
+            except (OSError, UnicodeDecodeError):
+                continue
+
+    types = {}
+    for strict in (True, False):
+        for mime_type, extensions in database.types_map_inv[strict].items():
+            for extension in extensions:
+                types.setdefault(extension, set()).add(mime_type)
+
+    rules = {}
+    for extension, mime_types in types.items():
+        if mime_types.issubset(IGNORED_TYPES):
+            continue
+
+        mimetype = set(mime_types).difference(IGNORED_TYPES)
+        for mime_type in list(mimetype):
+            mimetype.update(ALIASES.get(mime_type, []))
+            if __is_text(mime_type):
+                mimetype.add(PLAIN_TYPE)
+
+        # Extensions are compared case-sensitively, so also add upper case
+        # ones (e.g. '.JPG' as used by many cameras)
+        mimetype = "|".join(sorted(mimetype))
+        rules[extension] = mimetype
+        rules.setdefault(extension.upper(), mimetype)
+
+    return rules
+
+
+def __is_text(mime_type):
+    """
+        Determine if a MIME type is a textual format, so plain text is also
+        accepted for it.
+    """
+    return mime_type.startswith("text/") or mime_type in TEXT_TYPES or \
+        mime_type.endswith(("+json", "+xml"))
+
+
+__lock = threading.Lock()
+__rules = None
@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#
+# MIMEfield - MIME type mismatch detection tool
+# Signature core module
+# Copyright (c) 2022 by Ralf Kilian
+# Distributed under the MIT License (https://opensource.org/licenses/MIT)
+#
+# GitHub: https://github.com/urbanware-org/mimefield
+# GitLab: https://gitlab.com/urbanware-org/mimefield
+#
+
+import os
+import stat
+import struct
+
+# Number of bytes read from the beginning of a file in case no header size
+# was given
+HEADER_SIZE = 8192
+
+# Signatures (magic numbers) of common file formats at fixed offsets with the
+# MIME type and description the 'file' utility returns for them
+SIGNATURES = [
+    (0, b"\x89PNG\r\n\x1a\n", "image/png", "PNG image data"),
+    (0, b"\xff\xd8\xff", "image/jpeg", "JPEG image data"),
+    (0, b"GIF87a", "image/gif", "GIF image data"),
+    (0, b"GIF89a", "image/gif", "GIF image data"),
+    (0, b"II*\x00", "image/tiff", "TIFF image data"),
+    (0, b"MM\x00*", "image/tiff", "TIFF image data"),
+    (0, b"%PDF-", "application/pdf", "PDF document"),
+    (0, b"%!PS", "application/postscript", "PostScript document text"),
+    (0, b"{\\rtf", "text/rtf", "Rich Text Format data"),
+    (0, b"<?xml ", "text/xml", "XML 1.0 document"),
+    (0, b"PK\x03\x04", "application/zip", "Zip archive data"),
+    (0, b"\x1f\x8b", "application/gzip", "gzip compressed data"),
+    (0, b"BZh", "application/x-bzip2", "bzip2 compressed data"),
+    (0, b"\xfd7zXZ\x00", "application/x-xz", "XZ compressed data"),
+    (0, b"7z\xbc\xaf\x27\x1c", "application/x-7z-compressed",
+     "7-zip archive data"),
+    (0, b"Rar!\x1a\x07", "application/x-rar", "RAR archive data"),
+    (0, b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1", "application/x-ole-storage",
+     "Composite Document File V2 Document"),
+    (0, b"SQLite format 3\x00", "application/vnd.sqlite3",
+     "SQLite 3.x database"),
+    (0, b"\x7fELF", "application/x-executable", "ELF"),
+    (0, b"#!", "text/plain", "script text executable"),
+    (0, b"OggS", "audio/ogg", "Ogg data"),
+    (0, b"fLaC", "audio/flac", "FLAC audio bitstream data"),
+    (0, b"ID3", "audio/mpeg", "Audio file with ID3"),
+    (0, b"\x1a\x45\xdf\xa3", "video/x-matroska", "Matroska data"),
+    (0, b"RIFF", "application/octet-stream", "RIFF (little-endian) data"),
+    (0, b"wOFF", "font/woff", "Web Open Font Format"),
+    (0, b"wOF2", "font/woff2", "Web Open Font Format (Version 2)"),
+    (4, b"ftyp", "video/mp4", "ISO Media"),
+    (257, b"ustar", "application/x-tar", "POSIX tar archive"),
+]
+
+# MIME types of generic formats (containers, text and data) which may turn
+# out to be more specific formats when identified by other methods
+GENERIC_TYPES = {
+    "application/octet-stream",
+    "application/x-ole-storage",
+    "application/zip",
+    "text/plain",
+    "text/xml",
+}
+
+# Formats sharing a container signature, identified by further details
+ODF_TYPES = {
+    "application/vnd.oasis.opendocument.text": "OpenDocument Text",
+    "application/vnd.oasis.opendocument.spreadsheet":
+        "OpenDocument Spreadsheet",
+    "application/vnd.oasis.opendocument.presentation":
+        "OpenDocument Presentation",
+    "application/vnd.oasis.opendocument.graphics": "OpenDocument Drawing",
+    "application/epub+zip": "EPUB document",
+}
+OOXML_TYPES = [
+    (b"word/", "application/vnd.openxmlformats-officedocument."
+               "wordprocessingml.document", "Microsoft Word 2007+"),
+    (b"xl/", "application/vnd.openxmlformats-officedocument."
+             "spreadsheetml.sheet", "Microsoft Excel 2007+"),
+    (b"ppt/", "application/vnd.openxmlformats-officedocument."
+              "presentationml.presentation", "Microsoft PowerPoint 2007+"),
+]
+ISO_MEDIA_TYPES = {
+    b"qt  ": "video/quicktime",
+    b"M4A ": "audio/x-m4a",
+    b"heic": "image/heic",
+    b"avif": "image/avif",
+    b"3gp4": "video/3gpp",
+    b"3gp5": "video/3gpp",
+}
+RIFF_TYPES = {
+    b"WEBP": "image/webp",
+    b"WAVE": "audio/x-wav",
+    b"AVI ": "video/x-msvideo",
+}
+SCRIPT_TYPES = {
+    "sh": ("text/x-shellscript", "POSIX shell script"),
+    "bash": ("text/x-shellscript", "Bourne-Again shell script"),
+    "dash": ("text/x-shellscript", "POSIX shell script"),
+    "zsh": ("text/x-shellscript", "Paul Falstad's zsh script"),
+    "ksh": ("text/x-shellscript", "Korn shell script"),
+    "python": ("text/x-script.python", "Python script"),
+    "perl": ("text/x-perl", "Perl script text executable"),
+    "ruby": ("text/x-ruby", "Ruby script"),
+    "php": ("text/x-php", "PHP script"),
+    "node": ("application/javascript", "Node.js script"),
+}
+ELF_TYPES = {
+    1: ("application/x-object", "relocatable"),
+    2: ("application/x-executable", "executable"),
+    3: ("application/x-sharedlib", "shared object"),
+    4: ("application/x-coredump", "core file"),
+}
+
+
+def compile_signatures(mimetype):
+    """
+        Compile the given MIME type strings (separated with pipes, case
+        insensitive) into the signatures of all known formats that may match
+        them.
+    """
+    patterns = [mime.strip().lower() for mime in mimetype.split("|")
+                if mime.strip()]
+    signatures = []
+    for entry in SIGNATURES:
+        for mime_type, description in __get_variants(entry):
+            ftype = (mime_type + "|" + description).lower()
+            if any(pattern in ftype for pattern in patterns):
+                signatures.append(entry)
+                break
+
+    return patterns, signatures
+
+
+def get_file_type(path, header=None, status=None):
+    """
+        Get the MIME type and description of a single file from its status
+        (unless given, determined without following symbolic links) and the
+        signature at the beginning of it.
+    """
+    if status is None:
+        try:
+            status = os.lstat(path)
+        except OSError as e:
+            return "", f"cannot open `{path}' ({e.strerror})"
+
+    mode = status.st_mode
+    if stat.S_ISLNK(mode):
+        return "inode/symlink", f"symbolic link to {os.readlink(path)}"
+    if stat.S_ISDIR(mode):
+        return "inode/directory", "directory"
+    if stat.S_ISFIFO(mode):
+        return "inode/fifo", "fifo (named pipe)"
+    if stat.S_ISSOCK(mode):
+        return "inode/socket", "socket"
+    if stat.S_ISCHR(mode):
+        return "inode/chardevice", "character special"
+    if stat.S_ISBLK(mode):
+        return "inode/blockdevice", "block special"
+    if status.st_size == 0:
+        return "inode/x-empty", "empty"
+
+    if header is None:
+        try:
+            with open(path, "rb") as fh:
+                header = fh.read(HEADER_SIZE)
+        except OSError as e:
+            return "", f"cannot open `{path}' ({e.strerror})"
+
+    return get_header_type(header)
+
+
+def get_header_type(header):
+    """
+        Get the MIME type and description from the header (the first bytes)
+        of a file, falling back to plain text or binary data.
+    """
+    if not header:
+        return "application/x-empty", "empty"
+
+    file_type = get_signature_type(header)
+    if file_type is not None:
+        return file_type
+
+    if b"\x00" not in header:
+        try:
+            header.decode("ascii")
+            return "text/plain", "ASCII text"
+        except UnicodeDecodeError:
+            pass
+        try:
+            # The header may end within a multi-byte character
+            header.decode("utf-8")
+            return "text/plain", "Unicode text, UTF-8 text"
+        except UnicodeDecodeError as e:
+            if e.start >= len(header) - 3 and e.reason == \
+                    "unexpected end of data":
+                return "text/plain", "Unicode text, UTF-8 text"
+
+    return "application/octet-stream", "data"
+
+
+def get_signature_type(header):
+    """
+        Get the MIME type and description from the header of a file if it
+        starts with a known signature, otherwise return 'None'.
+    """
+    for offset, signature, mime_type, description in \
+            __index.get(header[:1], ()):
+        if header.startswith(signature):
+            return __refine(header, signature, mime_type, description)
+
+    for offset, signature, mime_type, description in __offset_signatures:
+        if header.startswith(signature, offset):
+            return __refine(header, signature, mime_type, description)
+
+    return None
+
+
+def verify_signature(header, compiled):
+    """
+        Check if the header of a file starts with one of the compiled
+        signatures and the format matches the expected MIME type strings.
+        Return the MIME type and description in that case, otherwise 'None'.
+    """
+    patterns, signatures = compiled
+    for offset, signature, mime_type, description in signatures:
+        if header.startswith(signature, offset):
+            mime_type, description = \
+                __refine(header, signature, mime_type, description)
+            ftype = (mime_type + "|" + description).lower()
+            if any(pattern in ftype for pattern in patterns):
+                return mime_type, description
+            return None
+
+    return None
+
+
+def __compile(signatures):
+    """
+        Index the signatures at the beginning of a file by their first byte,
+        so only the few signatures starting with the same byte have to be
+        compared with a header.
+    """
+    index = {}
+    offset_signatures = []
+    for entry in signatures:
+        if entry[0] == 0:
+            index.setdefault(entry[1][:1], []).append(entry)
+        else:
+            offset_signatures.append(entry)
+
+    return index, offset_signatures
+
+
+def __get_variants(entry):
+    """
+        Get all MIME types and descriptions a signature can be refined to.
+    """
+    offset, signature, mime_type, description = entry
+    variants = [(mime_type, description)]
+    if signature == b"PK\x03\x04":
+        variants += list(ODF_TYPES.items())
+        variants += [(ooxml_type, ooxml_description) for directory,
+                     ooxml_type, ooxml_description in OOXML_TYPES]
+        variants.append(("application/java-archive",
+                         "Java archive data (JAR)"))
+    elif signature == b"\x7fELF":
+        variants += [(elf_type, description) for elf_type, name in
+                     ELF_TYPES.values()]
+        variants.append(("application/x-pie-executable", description))
+    elif signature == b"#!":
+        variants += list(SCRIPT_TYPES.values())
+    elif signature == b"\x1a\x45\xdf\xa3":
+        variants.append(("video/webm", "WebM"))
+    elif signature == b"RIFF":
+        variants += [(riff_type, description) for riff_type in
+                     RIFF_TYPES.values()]
+    elif signature == b"ftyp":
+        variants += [(iso_type, description) for iso_type in
+                     ISO_MEDIA_TYPES.values()]
+
+    return variants
+
+
+def __has_interpreter(header, big_endian):
+    """
+        Check if the program headers of an ELF file (if inside the header)
+        request a program interpreter, which position-independent executables
+        do unlike shared libraries.
+    """
+    order = ">" if big_endian else "<"
+    try:
+        if header[4] == 2:
+            phoff = struct.unpack_from(order + "Q", header, 32)[0]
+            phentsize, phnum = struct.unpack_from(order + "HH", header, 54)
+        else:
+            phoff = struct.unpack_from(order + "I", header, 28)[0]
+            phentsize, phnum = struct.unpack_from(order + "HH", header, 42)
+        for number in range(phnum):
+            position = phoff + number * phentsize
+            if struct.unpack_from(order + "I", header, position)[0] == 3:
+                return True
+    except struct.error:
+        pass
+
+    return False
+
+
+def __refine(header, signature, mime_type, description):
+    """
+        Identify the actual format of containers and other signatures shared
+        by multiple formats.
+    """
+    if signature == b"PK\x03\x04":
+        # The ODF and EPUB formats store an uncompressed 'mimetype' file as
+        # the first entry of the archive
+        if header[30:38] == b"mimetype":
+            name_length, extra_length = struct.unpack("<HH", header[26:30])
+            start = 30 + name_length + extra_length
+            size = struct.unpack("<I", header[18:22])[0]
+            content = header[start:start + size].decode("ascii", "replace")
+            if content in ODF_TYPES:
+                return content, ODF_TYPES[content]
+        if header[30:39] == b"META-INF/":
+            return "application/java-archive", "Java archive data (JAR)"
+        if b"[Content_Types].xml" in header or b"_rels/.rels" in header:
+            for directory, ooxml_type, ooxml_description in OOXML_TYPES:
+                if directory in header:
+                    return ooxml_type, ooxml_description
+    elif signature == b"\x7fELF" and len(header) >= 18:
+        bits = {1: "32-bit", 2: "64-bit"}.get(header[4], "")
+        order = {1: "LSB", 2: "MSB"}.get(header[5], "")
+        elf_type = struct.unpack("<H" if order != "MSB" else ">H",
+                                 header[16:18])[0]
+        mime_type, name = ELF_TYPES.get(elf_type, (mime_type, "file"))
+        if elf_type == 3 and __has_interpreter(header, order == "MSB"):
+            mime_type, name = "application/x-pie-executable", \
+                "pie executable"
+        return mime_type, f"ELF {bits} {order} {name}"
+    elif signature == b"#!":
+        line = header[2:].split(b"\n", 1)[0].decode("utf-8", "replace")
+        words = line.split()
+        if words and os.path.basename(words[0]) == "env" and len(words) > 1:
+            words = words[1:]
+        if words:
+            interpreter = os.path.basename(words[0])
+            for name in (interpreter, interpreter.rstrip("0123456789.")):
+                if name in SCRIPT_TYPES:
+                    return SCRIPT_TYPES[name]
+            return mime_type, f"a {' '.join(words)} script text executable"
+    elif signature == b"ID3" and len(header) >= 5:
+        return mime_type, f"{description} version 2.{header[3]}.{header[4]}"
+    elif signature == b"\x1a\x45\xdf\xa3":
+        if b"webm" in header[:64]:
+            return "video/webm", "WebM"
+    elif signature == b"RIFF":
+        if header[8:12] in RIFF_TYPES:
+            return RIFF_TYPES[header[8:12]], description
+    elif signature == b"ftyp":
+        brand = header[8:12]
+        return ISO_MEDIA_TYPES.get(brand, mime_type), description
+
+    return mime_type, description
+
+
+__index, __offset_signatures = __compile(SIGNATURES)
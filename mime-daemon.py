@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#
+# MIMEfield - MIME type mismatch detection tool
+# MIME detection daemon script
+# Copyright (c) 2022 by Ralf Kilian
+# Distributed under the MIT License (https://opensource.org/licenses/MIT)
+#
+# GitHub: https://github.com/urbanware-org/mimefield
+# GitLab: https://gitlab.com/urbanware-org/mimefield
+#
+
+import os
+import signal
+import sys
+
+
+def main():
+    from core import clap
+    from core import common
+    from core import daemon
+
+    try:
+        p = clap.Parser()
+    except Exception as e:
+        bsname = os.path.basename(sys.argv[0])
+        print(f"{bsname}: error: {e}")
+        sys.exit(1)
+
+    p.set_description("Serve MIME type lookups over a Unix domain socket.")
+    p.set_epilog("Further information and usage examples can be found "
+                 "inside the documentation file for this script.")
+
+    # Optional arguments
+    p.add_avalue("-s", "--socket", "path of the socket to listen on (by "
+                 "default inside the runtime directory of the user)",
+                 "socket_path", None, False)
+    p.add_switch(None, "--version", "print the version number and exit", None,
+                 True, False)
+
+    if ("-h" in sys.argv) or ("--help" in sys.argv):
+        p.print_help()
+        sys.exit(0)
+    elif "--version" in sys.argv:
+        print(common.get_version())
+        sys.exit(0)
+
+    args = p.parse_args()
+    try:
+        server = daemon.DetectionServer(args.socket_path)
+    except Exception as e:
+        p.error(e)
+
+    # Remove the socket when terminated as well as when interrupted
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print(f"Listening on '{server.socket_path}'.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -32,25 +32,78 @@ def main():
     #             "inside the documentation file for this script.")
 
     # Required arguments
-    p.add_avalue("-e", "--extension", "File extension to check the MIME type "
-                 "for", "extension", None, True)
-    p.add_avalue("-t", "--type", "MIME type string (or a part of it, case "
-                 "insensitive, multiple enclosed with quotes and separated "
-                 "with pipes)", "mime", None, True)
     p.add_avalue("-p", "--path", "path of the directory from which to check "
                  "the files for MIME type mismatches (recursive)", "path",
                  None, True)
 
     # Optional arguments
+    p.add_switch("-a", "--auto", "check all files with an extension known to "
+                 "the system MIME database against the MIME type registered "
+                 "for it", "auto", True, False)
+    p.add_switch(None, "--batch", "pass the files to the 'file' utility in "
+                 "batches instead of one by one", "batch", True, False)
+    p.add_avalue(None, "--cache", "file to keep the MIME types of the files "
+                 "in, so unchanged files are not checked again on the next "
+                 "scan", "cache_file", None, False)
+    p.add_avalue(None, "--cache-size", "maximum number of files to keep in "
+                 "the cache (0 for the default of 1000000)", "cache_size", 0,
+                 False)
+    p.add_predef(None, "--executor", "type of workers to check multiple "
+                 "files in parallel with ('thread', 'process' or 'asyncio', "
+                 "'thread' by default)", "executor",
+                 ["thread", "process", "asyncio"], False)
     p.add_switch(None, "--cut-off", "cut off output to avoid long lines",
                  "cut_off", True, False)
+    p.add_avalue("-e", "--extension", "file extension to check the MIME type "
+                 "for (required unless a rules file or the automatic mode is "
+                 "given)", "extension", None, False)
+    p.add_switch(None, "--external-sort", "sort the mismatches on disk "
+                 "instead of holding all of them in memory", "external_sort",
+                 True, False)
+    p.add_predef(None, "--format", "format to print the mismatches in "
+                 "('tree' or 'plain' with one mismatch per line, 'tree' by "
+                 "default)", "output_format", ["tree", "plain"], False)
+    p.add_avalue(None, "--header-size", "number of bytes to read from the "
+                 "beginning of each file to get the MIME type from (e.g. "
+                 "4096 up to 65536, 0 reads as much as required",
+                 "header_size", 0, False)
+    p.add_switch(None, "--incremental", "only list the directories which "
+                 "have changed since the previous scan (requires a cache "
+                 "file)", "incremental", True, False)
     p.add_switch("-i", "--ignore-empty", "ignore empty files", "ignore_empty",
                  True, False)
+    p.add_avalue("-j", "--jobs", "number of files to check in parallel",
+                 "jobs", 1, False)
     p.add_avalue(None, "--maximum", "maximum number of files to check",
                  "maximum", 0, False)
-    p.add_predef("-m", "--method", "method to get the MIME type ('file' or "
-                 "'magic', both by default)", "method", ["file", "magic"],
+    p.add_avalue(None, "--memo-prefix", "number of bytes from the beginning "
+                 "of each file to remember the MIME type by, so files sharing "
+                 "the same prefix (and size class) are only checked once (0 "
+                 "disables it", "memo_prefix", 0, False)
+    p.add_predef("-m", "--method", "method to get the MIME type ('file', "
+                 "'magic' or the built-in 'signature' table, 'file' and "
+                 "'magic' by default)", "method",
+                 ["file", "magic", "signature"], False)
+    p.add_avalue("-r", "--rules", "TOML file mapping further extensions to "
+                 "their expected MIME type strings, all checked in a single "
+                 "pass", "rules", None, False)
+    p.add_switch(None, "--stats", "print the number of files identified by "
+                 "each method", "stats", True, False)
+    p.add_switch(None, "--stream", "print each mismatch as soon as it is "
+                 "found instead of sorted after the scan", "stream", True,
                  False)
+    p.add_avalue("-t", "--type", "MIME type string (or a part of it, case "
+                 "insensitive, multiple enclosed with quotes and separated "
+                 "with pipes, required along with the extension)", "mime",
+                 None, False)
+    p.add_avalue(None, "--tiers", "comma-separated methods to try one after "
+                 "another until one of them decides (e.g. 'empty,signature,"
+                 "magic,file'), overrides the method", "tiers", None, False)
+    p.add_switch(None, "--verify", "check the signatures of the expected "
+                 "MIME type first and only identify files not matching them",
+                 "verify", True, False)
+    p.add_avalue(None, "--walk-jobs", "number of directories to list in "
+                 "parallel", "walk_jobs", 1, False)
     p.add_switch(None, "--version", "print the version number and exit", None,
                  True, False)
 
@@ -64,9 +117,25 @@ def main():
         sys.exit(0)
 
     args = p.parse_args()
+    if (args.extension is None or args.mime is None) and \
+            args.rules is None and not args.auto:
+        p.error("The extension and the MIME type are required unless a "
+                "rules file or the automatic mode is given.")
+    elif (args.extension is None) != (args.mime is None):
+        p.error("The extension and the MIME type must be given together.")
+
     try:
+        rules = None
+        if args.rules is not None:
+            rules = main.load_rules(args.rules)
         main.get_mime_type(args.path, args.extension, args.mime, args.method,
-                           args.ignore_empty, args.cut_off, args.maximum)
+                           args.ignore_empty, args.cut_off, args.maximum,
+                           args.batch, args.header_size, args.verify,
+                           args.tiers, args.stats, args.jobs, args.executor,
+                           args.walk_jobs, rules, args.auto, args.cache_file,
+                           args.cache_size, args.incremental,
+                           args.memo_prefix, args.stream, args.external_sort,
+                           args.output_format)
     except Exception as e:
         p.error(e)
 
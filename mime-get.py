@@ -15,7 +15,40 @@ import os
 import sys
 
 
+def get_daemon_args(argv):
+    """
+        Get the path and the method from the command-line arguments if they
+        can be passed to the detection daemon as they are, otherwise 'None'.
+    """
+    path = None
+    method = None
+    index = 0
+    while index < len(argv) - 1:
+        if argv[index] in ("-p", "--path"):
+            path = argv[index + 1]
+        elif argv[index] in ("-m", "--method") and \
+                argv[index + 1] in ("file", "magic", "signature"):
+            method = argv[index + 1]
+        else:
+            return None
+        index += 2
+    if index != len(argv) or path is None:
+        return None
+
+    return path, method
+
+
 def main():
+    # A running detection daemon is asked first, so neither the argument
+    # parser nor the detection methods have to be loaded
+    daemon_args = get_daemon_args(sys.argv[1:])
+    if daemon_args is not None:
+        from core import client
+        ftype = client.get_mime_type(*daemon_args)
+        if ftype is not None:
+            print(ftype)
+            sys.exit(0)
+
     from core import clap
     from core import common
     from core import main
@@ -36,9 +69,10 @@ def main():
                  "from", "path", None, True)
 
     # Optional arguments
-    p.add_predef("-m", "--method", "method to get the MIME type ('file' or "
-                 "'magic', both by default)", "method", ["file", "magic"],
-                 False)
+    p.add_predef("-m", "--method", "method to get the MIME type ('file', "
+                 "'magic' or the built-in 'signature' table, 'file' and "
+                 "'magic' by default)", "method",
+                 ["file", "magic", "signature"], False)
     p.add_switch(None, "--version", "print the version number and exit", None,
                  True, False)
 
@@ -55,7 +89,8 @@ def main():
     try:
         if not os.path.isfile(args.path):
             raise Exception("Path must be a file")
-        print(main.get_mime_type(args.path, None, None, args.method))
+        with main.Detector(args.method) as detector:
+            print(detector.get_mime_type(args.path))
     except Exception as e:
         p.error(e)
 
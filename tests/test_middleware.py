@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+#
+# MIMEfield - MIME type mismatch detection tool
+# Upload middleware tests
+# Copyright (c) 2022 by Ralf Kilian
+# Distributed under the MIT License (https://opensource.org/licenses/MIT)
+#
+# GitHub: https://github.com/urbanware-org/mimefield
+# GitLab: https://gitlab.com/urbanware-org/mimefield
+#
+
+import asyncio
+import io
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from core import middleware  # noqa: E402
+
+BOUNDARY = "mimefield-boundary"
+
+PNG = b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR" + b"\x00" * 32
+
+
+def get_body(files, padding=0):
+    """
+        Build the body of a multipart form with the given files, each of them
+        given as tuple of the file name, its content type and its content.
+        The form field preceding the files gets the given number of bytes of
+        further headers.
+    """
+    body = b"--" + BOUNDARY.encode() + b"\r\n"
+    body += b"Content-Disposition: form-data; name=\"comment\"\r\n"
+    for index in range(padding // 1024):
+        body += f"X-Padding-{index}: ".encode() + b"x" * 1010 + b"\r\n"
+    body += b"\r\n"
+    body += b"not a file\r\n"
+    for index, (filename, content_type, content) in enumerate(files):
+        body += b"--" + BOUNDARY.encode() + b"\r\n"
+        body += (f"Content-Disposition: form-data; name=\"file{index}\"; "
+                 f"filename=\"{filename}\"\r\n").encode()
+        body += f"Content-Type: {content_type}\r\n\r\n".encode()
+        body += content + b"\r\n"
+    body += b"--" + BOUNDARY.encode() + b"--\r\n"
+
+    return body
+
+
+def app(environ, start_response):
+    """
+        Application accepting all requests and returning the number of bytes
+        it could read from the request body.
+    """
+    body = str(len(environ["wsgi.input"].read())).encode()
+    start_response("200 OK", [("Content-Type", "text/plain")])
+
+    return [body]
+
+
+class WSGIMiddlewareTest(unittest.TestCase):
+
+    def request(self, files, body=None, **options):
+        """
+            Send a multipart request with the given files (or the given body)
+            through the middleware and return the status, the response body
+            and the checked uploads.
+        """
+        if body is None:
+            body = get_body(files)
+        environ = {
+            "REQUEST_METHOD": "POST",
+            "CONTENT_TYPE": f"multipart/form-data; boundary={BOUNDARY}",
+            "CONTENT_LENGTH": str(len(body)),
+            "wsgi.input": io.BytesIO(body),
+        }
+        status = []
+
+        def start_response(value, headers):
+            status.append(value)
+
+        wrapped = middleware.WSGIMiddleware(app, **options)
+        try:
+            response = b"".join(wrapped(environ, start_response))
+        finally:
+            wrapped.close()
+
+        return status[0], response, environ[middleware.ENVIRON_KEY]
+
+    def test_text_formats(self):
+        files = [
+            ("data.json", "application/json", b"{\"key\": [1, 2, 3]}\n"),
+            ("table.csv", "text/csv", b"name,value\nfoo,1\nbar,2\n"),
+            ("page.html", "text/html",
+             b"<!DOCTYPE html>\n<html><body>Page</body></html>\n"),
+            ("notes.md", "text/markdown", b"# Notes\n\nSome text.\n"),
+        ]
+        status, response, uploads = self.request(files, auto=True)
+
+        self.assertEqual(status, "200 OK")
+        self.assertEqual(len(uploads), len(files))
+        for upload in uploads:
+            self.assertNotEqual(upload.verdict, "mismatch", upload)
+
+    def test_empty_file(self):
+        status, response, uploads = self.request(
+            [("a.txt", "text/plain", b"")], auto=True)
+
+        self.assertEqual(status, "200 OK")
+        self.assertEqual(uploads[0].ftype, "(empty)")
+        self.assertIsNone(uploads[0].verdict)
+
+    def test_fake_extension(self):
+        status, response, uploads = self.request(
+            [("image.png", "image/png", b"just some text\n")], auto=True)
+
+        self.assertTrue(status.startswith("415 "))
+        self.assertIn(b"image.png", response)
+        self.assertEqual(uploads[0].verdict, "mismatch")
+
+    def test_fake_content_type(self):
+        status, response, uploads = self.request(
+            [("image", "image/jpeg", PNG)], extension="pdf", mimetype="pdf")
+
+        self.assertTrue(status.startswith("415 "))
+        self.assertEqual(uploads[0].ftype.split("|")[0], "image/png")
+        self.assertEqual(uploads[0].verdict, "mismatch")
+
+    def test_match(self):
+        status, response, uploads = self.request(
+            [("image.png", "image/png", PNG)], auto=True)
+
+        self.assertEqual(status, "200 OK")
+        self.assertEqual(response, str(len(get_body(
+            [("image.png", "image/png", PNG)]))).encode())
+        self.assertEqual(uploads[0].verdict, "match")
+
+    def test_no_reject(self):
+        status, response, uploads = self.request(
+            [("image.png", "image/png", b"just some text\n")], auto=True,
+            reject=False)
+
+        self.assertEqual(status, "200 OK")
+        self.assertEqual(uploads[0].verdict, "mismatch")
+
+    def test_oversized_headers(self):
+        files = [("image.png", "image/png", b"just some text\n")]
+        status, response, uploads = self.request(
+            files, get_body(files, 102400), auto=True)
+
+        self.assertTrue(status.startswith("400 "))
+        self.assertEqual(uploads, [])
+
+    def test_missing_delimiter(self):
+        files = [("image.png", "image/png", b"just some text\n")]
+        body = get_body(files).rsplit(b"\r\n--", 1)[0]
+        status, response, uploads = self.request(files, body, auto=True)
+
+        self.assertTrue(status.startswith("400 "))
+        self.assertEqual(uploads, [])
+
+
+class ASGIMiddlewareTest(unittest.TestCase):
+
+    def request(self, files, body=None, **options):
+        """
+            Send a multipart request with the given files (or the given body)
+            through the middleware in chunks and return the status and the
+            body the application received.
+        """
+        if body is None:
+            body = get_body(files)
+        chunks = [body[i:i + 7] for i in range(0, len(body), 7)]
+        messages = [{"type": "http.request", "body": chunk,
+                     "more_body": True} for chunk in chunks]
+        messages.append({"type": "http.request", "body": b"",
+                         "more_body": False})
+        scope = {
+            "type": "http",
+            "method": "POST",
+            "headers": [(b"content-type", f"multipart/form-data; "
+                         f"boundary={BOUNDARY}".encode())],
+        }
+        sent = []
+        received = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        async def application(scope, receive, send):
+            while True:
+                message = await receive()
+                received.append(message.get("body", b""))
+                if not message.get("more_body"):
+                    break
+            await send({"type": "http.response.start", "status": 200,
+                        "headers": []})
+            await send({"type": "http.response.body", "body": b""})
+
+        wrapped = middleware.ASGIMiddleware(application, **options)
+        try:
+            asyncio.run(wrapped(scope, receive, send))
+        finally:
+            wrapped.close()
+
+        return sent[0]["status"], b"".join(received)
+
+    def test_text_formats(self):
+        files = [
+            ("data.json", "application/json", b"{\"key\": 1}\n"),
+            ("table.csv", "text/csv", b"name,value\nfoo,1\n"),
+            ("a.txt", "text/plain", b""),
+        ]
+        status, body = self.request(files, auto=True)
+
+        self.assertEqual(status, 200)
+        self.assertEqual(body, get_body(files))
+
+    def test_fake_extension(self):
+        status, body = self.request(
+            [("image.png", "image/png", b"just some text\n")], auto=True)
+
+        self.assertEqual(status, 415)
+        self.assertEqual(body, b"")
+
+    def test_oversized_headers(self):
+        files = [("image.png", "image/png", b"just some text\n")]
+        status, body = self.request(files, get_body(files, 102400),
+                                    auto=True)
+
+        self.assertEqual(status, 400)
+        self.assertEqual(body, b"")
+
+
+if __name__ == "__main__":
+    unittest.main()